@@ -1,7 +1,7 @@
 
 
-#!pip install adjustText nbstripout nbformat
-from adjustText import adjust_text
+#!pip install nbstripout nbformat
+from label_placement import place_labels
 
 import numpy as np 
 import pandas as pd 
@@ -170,7 +170,7 @@ ax.set_frame_on(True)
 fig.set_facecolor(((252 / 255), (244 / 255), (222/255), 0.3))
 
 annotations = [child for child in ax.get_children() if isinstance(child, mpltext.Annotation)]
-adjust_text(annotations, avoid_self=False)
+place_labels(ax, annotations)
 
 ax.get_children()[2].set(fontsize=4, alpha=0.3)
 
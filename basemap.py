@@ -0,0 +1,168 @@
+import hashlib
+import io
+import math
+import os
+import tempfile
+
+import mercantile
+import numpy as np
+import requests
+from matplotlib import patheffects
+from PIL import Image
+from pyproj import Transformer
+
+import contextily as cx
+
+from disk_cache import evict_lru, mark_used, record_write
+from web_mercator import web_mercator_extent
+
+tile_cache_dir = './tile_cache'
+tile_cache_max_bytes = 1024 * 1024 * 1024 # on-disk size cap, least recently used tiles go first
+offline_mode = os.environ.get('USFS_TILES_OFFLINE', '') == '1' # never fetch tiles over the network
+max_tiles = 64 # most tiles fetched for one map
+tile_size = 256
+min_zoom, max_zoom = 0, 18
+
+_to_lonlat = Transformer.from_crs('EPSG:3857', 'EPSG:4326', always_xy=True)
+
+
+def pick_zoom(extent, width_px, height_px, max_tiles=max_tiles):
+    ''' This function returns the zoom whose tiles match the output pixel
+    size of a Web Mercator extent, lowered until the extent needs at most
+    max_tiles tiles. '''
+    xmin, xmax, ymin, ymax = extent
+    width_m = max(xmax - xmin, 1.0)
+    height_m = max(ymax - ymin, 1.0)
+    metres_per_pixel = min(width_m / width_px, height_m / height_px)
+    zoom = math.ceil(math.log2(2 * web_mercator_extent / (tile_size * metres_per_pixel)))
+    zoom = max(min_zoom, min(max_zoom, zoom))
+
+    while zoom > min_zoom:
+        tile_m = 2 * web_mercator_extent / 2 ** zoom
+        tiles = (math.floor(xmax / tile_m) - math.floor(xmin / tile_m) + 1) * \
+                (math.floor(ymax / tile_m) - math.floor(ymin / tile_m) + 1)
+        if tiles <= max_tiles:
+            break
+        zoom -= 1
+    return zoom
+
+
+def tile_path(source_name, tile, cache_dir=tile_cache_dir):
+    ''' This function returns the cache path of a tile. '''
+    return os.path.join(cache_dir, source_name, str(tile.z), str(tile.x), f'{tile.y}.png')
+
+
+def source_url(source, tile):
+    ''' This function returns the URL of a tile from an xyzservices provider
+    or a {z}/{x}/{y} URL template. '''
+    if isinstance(source, str):
+        return source.format(z=tile.z, x=tile.x, y=tile.y)
+    return source.build_url(x=tile.x, y=tile.y, z=tile.z)
+
+
+def source_name(source):
+    ''' This function returns the cache directory name of a tile source. '''
+    if isinstance(source, str):
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    return source.name.replace('/', '_').replace(' ', '_')
+
+
+def fetch_tile(tile, source, session=None, offline=None, cache_dir=tile_cache_dir, tile_dir=None):
+    ''' This function returns a tile as an RGBA array, from tile_dir or the
+    cache when present, otherwise from the source. Missing tiles in offline
+    mode are transparent. '''
+    offline = offline_mode if offline is None else offline
+    if tile_dir is not None:
+        path = os.path.join(tile_dir, str(tile.z), str(tile.x), f'{tile.y}.png')
+    else:
+        path = tile_path(source_name(source), tile, cache_dir)
+
+    if os.path.exists(path):
+        if tile_dir is None:
+            mark_used(path)
+        with Image.open(path) as image:
+            return np.asarray(image.convert('RGBA'))
+    if offline or tile_dir is not None:
+        return np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+
+    http = session if session is not None else requests
+    try:
+        response = http.get(source_url(source, tile), headers={'User-Agent': 'usfs-map-builder'}, timeout=30)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Request error: {e}")
+        return np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+
+    # Every render worker may fetch the same tile at once, so each writes
+    # its own temporary file and the last replace wins.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    record_write(cache_dir, len(response.content), tile_cache_max_bytes, '.png')
+    with Image.open(io.BytesIO(response.content)) as image:
+        return np.asarray(image.convert('RGBA'))
+
+
+def evict_tiles(cache_dir=tile_cache_dir, max_bytes=tile_cache_max_bytes):
+    ''' This function deletes the least recently used tiles until the cache
+    fits in max_bytes. Function returns nothing. '''
+    evict_lru(cache_dir, max_bytes, '.png')
+
+
+def add_basemap(ax, source=None, max_tiles=max_tiles, offline=None, tile_dir=None,
+                cache_dir=tile_cache_dir, zorder=0, **imshow_kwargs):
+    ''' This function draws a basemap under an Axes in EPSG:3857, in place
+    of cx.add_basemap(ax, zoom=7).
+
+    The zoom is picked from the axes extent and its size in output pixels,
+    within max_tiles, and tiles go through a persistent on-disk cache. With
+    tile_dir, tiles are read from a local {z}/{x}/{y}.png directory only, and
+    a local tile server can be used by passing its URL template as source.
+
+    Returns:
+        The zoom level used.
+    '''
+    source = cx.providers.OpenStreetMap.HOT if source is None else source
+    xmin, xmax, ymin, ymax = ax.axis()
+    bbox = ax.get_window_extent()
+    zoom = pick_zoom((xmin, xmax, ymin, ymax), bbox.width, bbox.height, max_tiles)
+
+    west, south = _to_lonlat.transform(xmin, ymin)
+    east, north = _to_lonlat.transform(xmax, ymax)
+    tiles = list(mercantile.tiles(west, south, east, north, zooms=zoom))
+    if not tiles:
+        return zoom
+
+    xs = sorted({t.x for t in tiles})
+    ys = sorted({t.y for t in tiles})
+    mosaic = np.zeros((len(ys) * tile_size, len(xs) * tile_size, 4), dtype=np.uint8)
+    session = requests.Session()
+    for tile in tiles:
+        image = fetch_tile(tile, source, session, offline, cache_dir, tile_dir)
+        if image.shape[:2] != (tile_size, tile_size):
+            image = np.asarray(Image.fromarray(image).resize((tile_size, tile_size)))
+        row, col = ys.index(tile.y), xs.index(tile.x)
+        mosaic[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size] = image
+
+    top_left = mercantile.xy_bounds(mercantile.Tile(xs[0], ys[0], zoom))
+    bottom_right = mercantile.xy_bounds(mercantile.Tile(xs[-1], ys[-1], zoom))
+    ax.imshow(mosaic, extent=(top_left.left, bottom_right.right, bottom_right.bottom, top_left.top),
+              interpolation='bilinear', zorder=zorder, **imshow_kwargs)
+    ax.axis((xmin, xmax, ymin, ymax))
+    add_attribution(ax, '' if isinstance(source, str) else source.get('attribution', ''))
+    return zoom
+
+
+def add_attribution(ax, text, font_size=8):
+    ''' This function writes the tile attribution in the lower left corner
+    of an Axes, styled like cx.add_attribution, which calls plt.draw() and
+    so would create a pyplot figure in every render worker. Function returns
+    the Text artist. '''
+    return ax.text(0.005, 0.005, text, transform=ax.transAxes, size=font_size, wrap=True,
+                   path_effects=[patheffects.withStroke(linewidth=2, foreground='w')])
@@ -0,0 +1,93 @@
+"""Benchmark of webscrape.parse_catalog against the previous row-by-row
+parser on a saved synthetic copy of datasets.php.
+
+The synthetic page repeats catalog rows shaped like the live fcTable until it
+is the requested multiple of the current catalog size. It is written to
+benchmarks/data/ on the first run and reused afterwards.
+
+    python benchmarks/bench_catalog_parser.py [scale]
+"""
+import os
+import sys
+import time
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from webscrape import parse_catalog, table_attribs # noqa: E402
+
+catalog_rows = 200
+data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+row_template = """<tr>
+<td><p><strong>Activity Dataset {i}</strong></p><p>Feature class {i}</p></td>
+<td class="abstractCopy">The Actv_{i} feature class depicts planned and accomplished activities. More detail follows here…[see more]</td>
+<td><a href="edw_resources/fc/Actv_{i}.gdb.zip">ESRI Geodatabase</a><br><a href="edw_resources/shp/Actv_{i}.zip">Shapefile</a></td>
+</tr>
+"""
+
+
+def synthetic_page(scale):
+    """Returns the path of a synthetic catalog page with scale times the
+    current number of rows, writing it first if needed."""
+    path = os.path.join(data_dir, f'datasets_x{scale}.html')
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<html><head><title>EDW Datasets</title></head><body>\n')
+            f.write('<div id="nav">' + '<a href="#">link</a>' * 500 + '</div>\n')
+            f.write('<table class="fcTable"><tr><th>Name</th><th>Abstract</th><th>Download</th></tr>\n')
+            for i in range(catalog_rows * scale):
+                f.write(row_template.format(i=i))
+            f.write('</table></body></html>\n')
+    return path
+
+
+def legacy_parse(html_page, table_attribs):
+    """The previous extract body, appending one row at a time with df.loc."""
+    soup = BeautifulSoup(html_page, 'html.parser')
+    df = pd.DataFrame(columns=table_attribs)
+    table = soup.find('table', {'class':'fcTable'})
+    for tr in table.find_all('tr')[1:]:
+        tds = tr.find_all('td')
+        description = tr.find('td',{'class':'abstractCopy'}).get_text(strip=True)
+        links = tr.find_all('a', href=True)
+        for td in tds:
+            for p in td.find_all('p'):
+                for strong in p.find_all('strong'):
+                    df.loc[len(df)] = {
+                        table_attribs[0]: strong.get_text(strip=True),
+                        table_attribs[1]: description,
+                        table_attribs[2]: links[0]['href'],
+                        table_attribs[3]: links[1]['href'],
+                    }
+    df['Description'] = df['Description'].str.split('.').str.get(0)\
+                                        .str.replace("…[see more]", ' ', regex=False) + '.'
+    df['ESRI GDB'] = df['ESRI GDB'].apply(lambda x: '<a href="https://data.fs.usda.gov/geodata/edw/{}">ESRI Geodatabase</a>'.format(x))
+    df['Shapefile'] = df['Shapefile'].apply(lambda x: '<a href="https://data.fs.usda.gov/geodata/edw/{}">Shapefile</a>'.format(x))
+    return df
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(scales):
+    for scale in scales:
+        with open(synthetic_page(scale), encoding='utf-8') as f:
+            html_page = f.read()
+        df, new_time = timed(parse_catalog, html_page, table_attribs)
+        line = f"x{scale:<4} {len(df):>7} rows  parse_catalog {new_time:8.3f}s"
+        # The legacy parser is quadratic, so only run it on the smaller pages.
+        if scale <= 10:
+            old_df, old_time = timed(legacy_parse, html_page, table_attribs)
+            assert old_df.equals(df), "parsers disagree"
+            line += f"  legacy {old_time:8.3f}s  speedup {old_time / new_time:6.1f}x"
+        print(line)
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1, 10, 100])
@@ -0,0 +1,75 @@
+"""Benchmark of the vectorized functions.centroids against the previous
+list-and-sjoin implementation.
+
+The synthetic layer has many provinces, each a MultiPolygon of one to eight
+non-overlapping square parts, so every branch of the label rule is hit.
+
+    python benchmarks/bench_centroids.py [n_provinces ...]
+"""
+import os
+import sys
+import time
+
+import geopandas
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from functions import centroids # noqa: E402
+
+
+def synthetic_provinces(n_provinces, seed=0):
+    """Returns n_provinces multipart provinces on a grid in EPSG:3857."""
+    rng = np.random.default_rng(seed)
+    geometries = []
+    for i in range(n_provinces):
+        x0, y0 = (i % 1000) * 1000.0, (i // 1000) * 1000.0
+        n_parts = rng.integers(1, 9)
+        parts = [shapely.box(x0 + 110 * p, y0, x0 + 110 * p + 100, y0 + 100) for p in range(n_parts)]
+        geometries.append(MultiPolygon(parts))
+    return geopandas.GeoDataFrame({'PROVINCE_ID': np.arange(n_provinces)}, geometry=geometries, crs='EPSG:3857')
+
+
+def legacy_centroids(clipped_eco_provinces):
+    """The previous implementation: Python lists, MultiPolygon rebuilds and
+    a spatial join to recover the attributes."""
+    polygon_lists = [list(multipol.geoms) if multipol.geom_type == 'MultiPolygon' else [multipol] for multipol in clipped_eco_provinces.geometry]
+    points = []
+    for plist in polygon_lists:
+        num_polygons = len(plist)
+        if num_polygons > 3:
+            points.append(MultiPolygon(plist).representative_point())
+        elif num_polygons == 1:
+            points.append(plist[0].representative_point())
+        else:
+            for polygon in plist:
+                points.append(polygon.representative_point())
+    centroids_gdf = geopandas.GeoDataFrame(data=points)
+    centroids_gdf = centroids_gdf.set_geometry(col=centroids_gdf[0])
+    centroids_gdf = centroids_gdf.set_crs(crs=clipped_eco_provinces.crs)
+    return centroids_gdf.sjoin(clipped_eco_provinces)
+
+
+def label_set(gdf):
+    return sorted(zip(gdf['PROVINCE_ID'], shapely.get_x(gdf.geometry.values), shapely.get_y(gdf.geometry.values)))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(sizes):
+    for n_provinces in sizes:
+        provinces = synthetic_provinces(n_provinces)
+        expected, legacy_time = timed(legacy_centroids, provinces)
+        actual, new_time = timed(centroids, provinces)
+        assert label_set(expected) == label_set(actual), "label points differ"
+        print(f"{n_provinces:>8} provinces {len(actual):>8} labels  legacy {legacy_time:8.3f}s  "
+              f"vectorized {new_time:8.3f}s  speedup {legacy_time / new_time:6.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1_000, 10_000, 100_000])
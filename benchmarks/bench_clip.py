@@ -0,0 +1,65 @@
+"""Benchmark of functions.fast_clip against geopandas.clip, the clip that
+map_utilities used before.
+
+A dense synthetic activity layer of small polygons is clipped to a large
+irregular "state" polygon. Most features lie well inside it, which is the
+case fast_clip speeds up.
+
+    python benchmarks/bench_clip.py [n_features ...]
+"""
+import os
+import sys
+import time
+
+import geopandas
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from functions import fast_clip # noqa: E402
+
+
+def synthetic_layer(n_features, seed=0):
+    """Returns n_features small, detailed polygons scattered over a 10x10
+    degree extent in EPSG:4269."""
+    rng = np.random.default_rng(seed)
+    centers = shapely.points(rng.uniform(-110, -100, n_features), rng.uniform(35, 45, n_features))
+    polygons = shapely.buffer(centers, rng.uniform(0.01, 0.08, n_features), quad_segs=16)
+    return geopandas.GeoDataFrame({'ACTIVITY_ID': np.arange(n_features)}, geometry=polygons, crs='EPSG:4269')
+
+
+def synthetic_state():
+    """Returns an irregular polygon covering most of the synthetic extent."""
+    angles = np.linspace(0, 2 * np.pi, 720, endpoint=False)
+    radius = 4.5 + 0.4 * np.sin(angles * 9)
+    ring = np.column_stack([-105 + radius * np.cos(angles), 40 + radius * np.sin(angles)])
+    return geopandas.GeoSeries([shapely.Polygon(ring)], crs='EPSG:4269')
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def same_result(expected, actual):
+    expected = expected.sort_index()
+    actual = actual.sort_index()
+    return (expected.index.equals(actual.index)
+            and bool(shapely.equals(np.asarray(expected.geometry.values), np.asarray(actual.geometry.values)).all()))
+
+
+def main(sizes):
+    state = synthetic_state()
+    for n_features in sizes:
+        layer = synthetic_layer(n_features)
+        layer.sindex # build the tree outside the timings, both clips use it
+        expected, clip_time = timed(geopandas.clip, layer, state)
+        actual, fast_time = timed(fast_clip, layer, state)
+        assert same_result(expected, actual), "fast_clip differs from geopandas.clip"
+        print(f"{n_features:>8} features  geopandas.clip {clip_time:8.3f}s  "
+              f"fast_clip {fast_time:8.3f}s  speedup {clip_time / fast_time:6.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 500_000])
@@ -0,0 +1,72 @@
+"""Benchmark of label_placement.place_labels: placement time and leftover
+overlaps against label count, with adjust_text alongside when installed.
+
+Labels are styled like the province labels of build_map and scattered over
+a 5x7 inch, 300 dpi figure.
+
+    python benchmarks/bench_label_placement.py [n_labels ...]
+"""
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use('agg')
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from label_placement import place_labels # noqa: E402
+
+try:
+    from adjustText import adjust_text
+except ImportError:
+    adjust_text = None
+
+
+def labelled_axes(n_labels, seed=0):
+    rng = np.random.default_rng(seed)
+    fig = Figure(figsize=(5, 7), dpi=300, layout='tight')
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    xs, ys = rng.uniform(0.05, 0.95, n_labels), rng.uniform(0.05, 0.95, n_labels)
+    annotations = [ax.annotate(text=str(i % 100), xy=(x, y), ha='center', va='center', fontsize=6, color='white',
+                               bbox=dict(boxstyle='circle,pad=0.2', facecolor='black', alpha=0.85))
+                   for i, (x, y) in enumerate(zip(xs, ys))]
+    return fig, ax, annotations
+
+
+def count_overlaps(fig, annotations):
+    fig.draw_without_rendering()
+    renderer = fig.canvas.get_renderer()
+    boxes = np.array([a.get_window_extent(renderer).extents for a in annotations])
+    overlaps = 0
+    for i in range(len(boxes)):
+        b = boxes[i]
+        others = boxes[i + 1:]
+        overlaps += int(np.sum((b[0] < others[:, 2]) & (b[2] > others[:, 0]) & (b[1] < others[:, 3]) & (b[3] > others[:, 1])))
+    return overlaps
+
+
+def main(sizes):
+    for n_labels in sizes:
+        fig, ax, annotations = labelled_axes(n_labels)
+        before = count_overlaps(fig, annotations)
+        stats = place_labels(ax, annotations)
+        line = (f"{n_labels:>6} labels  overlaps {before:>7} -> {count_overlaps(fig, annotations):>6}  "
+                f"place_labels {stats['measure_seconds']:7.3f}s measuring + {stats['seconds']:7.3f}s placing "
+                f"({stats['placed']} placed)")
+        if adjust_text is not None and n_labels <= 500:
+            fig, ax, annotations = labelled_axes(n_labels)
+            start = time.perf_counter()
+            adjust_text(annotations, ax=ax, avoid_self=False)
+            line += (f"  adjust_text {time.perf_counter() - start:7.3f}s "
+                     f"({count_overlaps(fig, annotations)} overlaps)")
+        print(line)
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [25, 100, 500, 2000])
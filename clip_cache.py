@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import geopandas
+
+from disk_cache import evict_lru, mark_used, record_write
+
+cache_dir = './clip_cache'
+cache_max_bytes = 2 * 1024 * 1024 * 1024 # on-disk size cap, least recently used entries go first
+memory_max_entries = 32 # (dataset, state) pairs kept in memory
+
+_memory = OrderedDict()
+
+
+def dataset_version(path):
+    ''' This function returns the (dataset, version) key of a dataset file or
+    GDB directory. The version changes whenever a file in it changes. '''
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, f) for root, _, files in os.walk(path) for f in files)
+    hasher = hashlib.sha256()
+    for p in paths:
+        stat = os.stat(p)
+        hasher.update(f'{os.path.relpath(p, path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    name = os.path.basename(os.path.normpath(path))
+    return name, hasher.hexdigest()[:16]
+
+
+def entry_paths(version, state_name, cache_dir=cache_dir):
+    ''' This function returns the feature and label file paths of a cache
+    entry. '''
+    dataset, digest = version
+    directory = os.path.join(cache_dir, dataset, digest)
+    state = state_name.replace(os.sep, '_')
+    return (os.path.join(directory, state + '.features.parquet'),
+            os.path.join(directory, state + '.labels.parquet'))
+
+
+def get(version, state_name, cache_dir=cache_dir):
+    ''' This function returns the cached (clipped features, label points) of
+    a dataset version and state, or None on a miss. '''
+    key = (version, state_name)
+    if key in _memory:
+        _memory.move_to_end(key)
+        features, labels = _memory[key]
+        return features.copy(), labels.copy()
+
+    features_path, labels_path = entry_paths(version, state_name, cache_dir)
+    if not (os.path.exists(features_path) and os.path.exists(labels_path)):
+        return None
+    features = geopandas.read_parquet(features_path)
+    labels = geopandas.read_parquet(labels_path)
+    mark_used(features_path)
+    mark_used(labels_path)
+    remember(key, features, labels)
+    return features.copy(), labels.copy()
+
+
+def put(version, state_name, features, labels, cache_dir=cache_dir, max_bytes=cache_max_bytes):
+    ''' This function stores the clipped features and label points of a
+    dataset version and state, and drops the entries of every other version
+    of the same dataset. Function returns nothing. '''
+    dataset, digest = version
+    for stale in list(_memory):
+        if stale[0][0] == dataset and stale[0][1] != digest:
+            del _memory[stale]
+    dataset_dir = os.path.join(cache_dir, dataset)
+    if os.path.isdir(dataset_dir):
+        for name in os.listdir(dataset_dir):
+            if name != digest:
+                shutil.rmtree(os.path.join(dataset_dir, name), ignore_errors=True)
+
+    # Parquet needs string column names.
+    labels = labels[[c for c in labels.columns if isinstance(c, str)]]
+
+    features_path, labels_path = entry_paths(version, state_name, cache_dir)
+    os.makedirs(os.path.dirname(features_path), exist_ok=True)
+    write_parquet(features, features_path)
+    write_parquet(labels, labels_path)
+
+    remember((version, state_name), features.copy(), labels.copy())
+    size = os.path.getsize(features_path) + os.path.getsize(labels_path)
+    record_write(cache_dir, size, max_bytes, '.features.parquet', '.labels.parquet')
+
+
+def write_parquet(gdf, path):
+    ''' This function writes a GeoDataFrame to path through a temporary file
+    of its own, so render workers storing the same state at the same time
+    never write to or replace each other's file. Function returns nothing. '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def remember(key, features, labels):
+    ''' This function adds an entry to the in-memory LRU tier. Function
+    returns nothing. '''
+    _memory[key] = (features, labels)
+    _memory.move_to_end(key)
+    while len(_memory) > memory_max_entries:
+        _memory.popitem(last=False)
+
+
+def evict(cache_dir=cache_dir, max_bytes=cache_max_bytes):
+    ''' This function deletes the least recently used entries until the
+    on-disk cache fits in max_bytes. Function returns nothing. '''
+    evict_lru(cache_dir, max_bytes, '.features.parquet', '.labels.parquet')
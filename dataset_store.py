@@ -0,0 +1,252 @@
+import glob
+import os
+import re
+import sys
+
+import geopandas
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+
+store_directory = 'dataset_store'
+store_crs = 'EPSG:3857'
+row_group_size = 8192 # features per row group, the unit readers can skip by bbox
+bbox_columns = ('xmin', 'ymin', 'xmax', 'ymax')
+lod_tolerances = (25, 100, 400, 1600, 6400) # simplification tolerances of the LOD levels, in metres
+lossless_pixel_fraction = 0.5 # a level is visually lossless if its tolerance is under this much of a pixel
+
+
+def store_path(gdb_path, layer, store_dir=store_directory):
+    """Returns the GeoParquet path of a GDB layer in the dataset store."""
+    gdb = os.path.splitext(os.path.basename(os.path.normpath(gdb_path)))[0]
+    return os.path.join(store_dir, gdb, f"{layer}.parquet")
+
+
+def build_store(gdb_path, layer, store_dir=store_directory, row_group_size=row_group_size,
+                lod_tolerances=lod_tolerances):
+    """Converts one GDB layer into a GeoParquet file in the dataset store.
+
+    The features are projected to EPSG:3857 once, sorted along a Hilbert
+    curve so each row group covers a compact area, and written with a bbox
+    covering column whose row group statistics let readers skip row groups
+    outside their extent.
+
+    Args:
+        gdb_path: The path to the GDB.
+        layer: The layer name.
+        store_dir: The root directory of the dataset store.
+        row_group_size: The number of features per row group.
+        lod_tolerances: The tolerances of the LOD levels written next to
+            the file, see build_lods. None or empty for none.
+
+    Returns:
+        The path of the written file.
+    """
+    gdf = geopandas.read_file(gdb_path, layer=layer, engine='pyogrio')
+    gdf = gdf.to_crs(store_crs)
+    if gdf.geometry.name != 'geometry':
+        gdf = gdf.rename_geometry('geometry')
+
+    # Missing and empty geometries have no Hilbert position, so they go last.
+    valid = (gdf.geometry.notna() & ~gdf.geometry.is_empty).to_numpy()
+    distances = np.full(len(gdf), np.iinfo(np.uint32).max, dtype=np.uint64)
+    if valid.any():
+        distances[valid] = gdf.geometry[valid].hilbert_distance()
+    gdf = gdf.iloc[np.argsort(distances, kind='stable')]
+
+    path = store_path(gdb_path, layer, store_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    gdf.to_parquet(path + '.tmp', index=False, write_covering_bbox=True, row_group_size=row_group_size)
+    os.replace(path + '.tmp', path)
+    print(f"Stored {len(gdf)} features of '{layer}' in {path}")
+    if lod_tolerances:
+        build_lods(path, lod_tolerances, row_group_size=row_group_size)
+    return path
+
+
+def lod_path(path, tolerance):
+    """Returns the path of the LOD level of a store file at a tolerance."""
+    base, ext = os.path.splitext(path)
+    return f"{base}.lod{int(tolerance)}{ext}"
+
+
+def lod_levels(path):
+    """Returns {tolerance: path} of the LOD levels stored next to a file."""
+    base, ext = os.path.splitext(path)
+    levels = {}
+    for lod in glob.glob(glob.escape(base) + '.lod*' + ext):
+        match = re.fullmatch(r'lod(\d+)', os.path.splitext(lod[len(base) + 1:])[0])
+        if match:
+            levels[int(match.group(1))] = lod
+    return levels
+
+
+def is_coverage(geometries):
+    """Check if the polygons of a layer form a valid coverage: no overlaps,
+    and neighbours share their borders exactly."""
+    polygonal = np.isin(shapely.get_type_id(geometries),
+                        [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])
+    return (hasattr(shapely, 'coverage_simplify') and bool(polygonal.any())
+            and bool(shapely.coverage_is_valid(geometries[polygonal])))
+
+
+def simplify_coverage(geometries, tolerance, coverage=None):
+    """Simplifies polygons without opening gaps or overlaps between them.
+
+    Layers like the eco provinces are coverages, whose neighbours share
+    borders; coverage_simplify (shapely 2.1, GEOS 3.12) simplifies each
+    shared border once, so both sides stay identical. It does not check its
+    input, so overlapping layers like the FACTS activities are checked with
+    is_coverage first; they, and every layer on older shapely, are
+    simplified one geometry at a time with their topology preserved. Pass
+    coverage to reuse an is_coverage result across tolerances.
+    """
+    if coverage is None:
+        coverage = is_coverage(geometries)
+    polygonal = np.isin(shapely.get_type_id(geometries),
+                        [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])
+    simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    if coverage:
+        simplified[polygonal] = shapely.coverage_simplify(geometries[polygonal], tolerance)
+    return simplified
+
+
+def build_lods(path, tolerances=lod_tolerances, quantize=False, row_group_size=row_group_size):
+    """Writes the level of detail (LOD) pyramid of a store file.
+
+    Each level is a copy of the file with its geometries simplified at one
+    tolerance, in the same order and with the same bbox covering column, so
+    read_store reads any level the same way. Renderers pick the coarsest
+    level that still looks the same at their scale, see pick_lod.
+
+    Args:
+        path: The GeoParquet path from store_path.
+        tolerances: The simplification tolerances, in metres.
+        quantize: if true, coordinates are also snapped to a grid of a
+            quarter of the tolerance, which shrinks the files further.
+        row_group_size: The number of features per row group.
+
+    Returns:
+        A list of the written paths.
+    """
+    for stale in lod_levels(path).values():
+        os.remove(stale)
+
+    gdf = read_store(path)
+    geometries = np.asarray(gdf.geometry.values)
+    source_vertices = int(shapely.get_num_coordinates(geometries).sum())
+    coverage = is_coverage(geometries)
+    paths = []
+    for tolerance in sorted(tolerances):
+        simplified = simplify_coverage(geometries, tolerance, coverage)
+        if quantize:
+            simplified = shapely.set_precision(simplified, tolerance / 4)
+        level = gdf.copy()
+        level['geometry'] = geopandas.GeoSeries(simplified, index=gdf.index, crs=store_crs)
+        level_path = lod_path(path, tolerance)
+        level.to_parquet(level_path + '.tmp', index=False, write_covering_bbox=True, row_group_size=row_group_size)
+        os.replace(level_path + '.tmp', level_path)
+        vertices = int(shapely.get_num_coordinates(simplified).sum())
+        print(f"LOD {tolerance} m of {os.path.basename(path)}: {vertices} of {source_vertices} vertices")
+        paths.append(level_path)
+    return paths
+
+
+def pick_lod(path, bounds, width_px):
+    """Returns the coarsest LOD level of a store file that is visually
+    lossless when bounds (xmin, ymin, xmax, ymax in EPSG:3857) are drawn
+    width_px pixels wide, or path itself if no level is."""
+    metres_per_pixel = (bounds[2] - bounds[0]) / width_px
+    lossless = [tolerance for tolerance in lod_levels(path)
+                if tolerance <= metres_per_pixel * lossless_pixel_fraction]
+    return lod_path(path, max(lossless)) if lossless else path
+
+
+def build_stores(gdb_directory, store_dir=store_directory, only=None):
+    """Converts every layer of every GDB in a directory into the dataset store.
+
+    Args:
+        gdb_directory: The directory containing the GDBs.
+        store_dir: The root directory of the dataset store.
+        only: if given, only the GDB names in this set are converted.
+
+    Returns:
+        A list of the written paths.
+    """
+    paths = []
+    for filename in sorted(os.listdir(gdb_directory)):
+        if not filename.endswith('.gdb') or (only is not None and filename not in only):
+            continue
+        gdb_path = os.path.join(gdb_directory, filename)
+        for layer, geometry_type in pyogrio.list_layers(gdb_path):
+            if geometry_type is None:
+                continue
+            try:
+                paths.append(build_store(gdb_path, layer, store_dir))
+            except Exception as e:
+                print(f"Error storing '{filename}:{layer}': {e}")
+    return paths
+
+
+def row_group_bounds(parquet_file):
+    """Returns the (xmin, ymin, xmax, ymax) of every row group, from the
+    statistics of the bbox covering column."""
+    metadata = parquet_file.metadata
+    positions = {}
+    for i in range(metadata.num_columns):
+        path = metadata.schema.column(i).path
+        if path in {f'bbox.{c}' for c in bbox_columns}:
+            positions[path.split('.')[1]] = i
+
+    bounds = []
+    for g in range(metadata.num_row_groups):
+        group = metadata.row_group(g)
+        stats = {c: group.column(positions[c]).statistics for c in bbox_columns}
+        bounds.append((stats['xmin'].min, stats['ymin'].min, stats['xmax'].max, stats['ymax'].max))
+    return bounds
+
+
+def read_store(path, bbox=None, columns=None):
+    """Reads a layer from the dataset store.
+
+    The file is memory-mapped, and with a bbox only the row groups whose
+    extent intersects it are read, then only the rows whose own bbox does.
+
+    Args:
+        path: The GeoParquet path from store_path.
+        bbox: An optional (xmin, ymin, xmax, ymax) in EPSG:3857.
+        columns: An optional list of attribute columns to read.
+
+    Returns:
+        A GeoDataFrame in EPSG:3857.
+    """
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    read_columns = None if columns is None else list(columns) + ['geometry', 'bbox']
+
+    if bbox is None:
+        table = parquet_file.read(columns=read_columns)
+    else:
+        xmin, ymin, xmax, ymax = bbox
+        groups = [g for g, (gxmin, gymin, gxmax, gymax) in enumerate(row_group_bounds(parquet_file))
+                  if gxmin <= xmax and gxmax >= xmin and gymin <= ymax and gymax >= ymin]
+        table = parquet_file.read_row_groups(groups, columns=read_columns)
+        boxes = table.column('bbox')
+        field = {c: pc.struct_field(boxes, [boxes.type.get_field_index(c)]) for c in bbox_columns}
+        mask = pc.and_(
+            pc.and_(pc.less_equal(field['xmin'], xmax), pc.greater_equal(field['xmax'], xmin)),
+            pc.and_(pc.less_equal(field['ymin'], ymax), pc.greater_equal(field['ymax'], ymin)))
+        table = table.filter(mask)
+
+    df = table.drop(['bbox']).to_pandas()
+    geometry = shapely.from_wkb(df.pop('geometry').to_numpy())
+    return geopandas.GeoDataFrame(df, geometry=geometry, crs=store_crs)
+
+
+def main():
+    gdb_directory = sys.argv[1] if len(sys.argv) > 1 else 'gdb_directory'
+    build_stores(gdb_directory, store_directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import threading
+
+# Tracked size in bytes of every cache written by this process, see
+# record_write.
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+def mark_used(path):
+    ''' This function records a use of a cache file. Its mtime is the last
+    use, which evict_lru goes by. Function returns nothing. '''
+    os.utime(path)
+
+
+def evict_lru(cache_dir, max_bytes, suffix, companion_suffix=None, on_remove=None):
+    ''' This function deletes the least recently used entries of an on-disk
+    cache until it fits in max_bytes. An entry is a file ending in suffix,
+    plus the file with companion_suffix in its place if there is one, e.g.
+    a page and its metadata. on_remove is called with the path of every
+    entry removed. Function returns the size of the cache in bytes. '''
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(root, name)
+            paths = [path]
+            if companion_suffix is not None:
+                paths.append(path[:-len(suffix)] + companion_suffix)
+            try:
+                mtime = os.path.getmtime(path)
+                size = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, size, path, paths))
+
+    total = sum(entry[1] for entry in entries)
+    for _, size, path, paths in sorted(entries):
+        if total <= max_bytes:
+            break
+        for p in paths:
+            if os.path.exists(p):
+                os.remove(p)
+        if on_remove is not None:
+            on_remove(path)
+        total -= size
+    return total
+
+
+def record_write(cache_dir, size, max_bytes, suffix, companion_suffix=None, on_remove=None):
+    ''' This function accounts for size bytes just written to a cache and
+    evicts only once the cache goes over max_bytes, so writes do not walk
+    the whole cache. The size is tracked per process: the first write scans
+    the cache once, and every eviction scan resets it, which also picks up
+    what other processes wrote. Function returns nothing. '''
+    key = os.path.abspath(cache_dir)
+    with _sizes_lock:
+        if key in _sizes:
+            _sizes[key] += size
+        else:
+            _sizes[key] = evict_lru(cache_dir, max_bytes, suffix, companion_suffix, on_remove)
+        if _sizes[key] > max_bytes:
+            _sizes[key] = evict_lru(cache_dir, max_bytes, suffix, companion_suffix, on_remove)
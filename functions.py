@@ -1,4 +1,3 @@
-from adjustText import adjust_text
 import base64
 from io import BytesIO
 import numpy as np 
@@ -8,6 +7,7 @@ import matplotlib.pyplot as plt
 import matplotlib as mpl
 
 import geopandas 
+import shapely
 
 import re
 import contextily as cx
@@ -25,8 +25,15 @@ from matplotlib.lines import Line2D
 from matplotlib.legend import Legend
 from matplotlib.legend_handler import HandlerTuple, HandlerLine2D
 from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from shapely.validation import make_valid
 
+import clip_cache
+from label_placement import place_labels
+from basemap import add_basemap
+import pyogrio
+from dataset_store import pick_lod, read_store
+
 
 
 def set_dpi():
@@ -46,17 +53,154 @@ def data_transform(df):
     
     return df
 
+def membership_key(conn, table, state_name, states_table='tl_2012_us_state', membership_table='state_membership'):
+    # The primary key to join state_membership (see optimize_postgis) on, or
+    # None if its rows for the table are missing or stale: a reload swaps in
+    # a new table with a new OID, so rows built for the old one don't match.
+    from psycopg import sql
+    if conn.execute("SELECT to_regclass(%s)", (membership_table,)).fetchone()[0] is None:
+        return None
+    current = conn.execute(sql.SQL("""
+        SELECT m.dataset_oid = to_regclass(format('public.%%I', %(table)s::text))::oid
+        FROM {membership} m JOIN {states} s ON m.state_fips = s.statefp
+        WHERE s.name = %(state_name)s AND m.dataset = %(table)s LIMIT 1
+    """).format(membership=sql.Identifier(membership_table), states=sql.Identifier(states_table)),
+        {'table': table, 'state_name': state_name}).fetchone()
+    if not (current and current[0]):
+        return None
+    key = conn.execute("""
+        SELECT a.attname FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = to_regclass(format('public.%%I', %s::text)) AND i.indisprimary AND i.indnatts = 1
+    """, (table,)).fetchone()
+    return key[0] if key else None
+
+def postgis_column(name):
+    # The loaders in load_geodb_to_postgis launder column names like ogr2ogr
+    # does (see launder there), so PROVINCE_ID is stored as province_id.
+    return re.sub(r"[^a-z0-9_]", "_", name.lower())
+
+def query_state_features(conn, table, state_name, columns=None, geometry_column='shape', states_table='tl_2012_us_state'):
+    # Clips a PostGIS table to one state in a single round trip. Features
+    # fully inside the state are kept as they are and only the boundary ones
+    # are intersected. The candidates come from the state_membership lookup
+    # when it is current for the table, otherwise from ST_Intersects on the
+    # table's GiST index. psycopg is only imported here, so build_map works
+    # without it for datasets that are not in PostGIS.
+    # columns are the names build_map reads, e.g. PROVINCE_ID; they are
+    # selected from their laundered columns and come back under these names.
+    from psycopg import sql
+
+    key = membership_key(conn, table, state_name, states_table)
+    if key is not None:
+        candidates = sql.SQL("""
+            FROM state_membership m JOIN s ON m.state_fips = s.statefp AND m.dataset = %(table)s
+            JOIN {table} t ON t.{key} = m.feature_id
+        """).format(table=sql.Identifier(table), key=sql.Identifier(key))
+    else:
+        candidates = sql.SQL("FROM {table} t JOIN s ON ST_Intersects(t.{geometry}, s.geom)").format(
+            table=sql.Identifier(table), geometry=sql.Identifier(geometry_column))
+
+    select_columns = [sql.SQL('t.{} AS {}').format(sql.Identifier(postgis_column(c)), sql.Identifier(c))
+                      for c in (columns or [])]
+    query = sql.SQL("""
+        WITH s AS MATERIALIZED (
+            SELECT min(statefp) AS statefp,
+                   ST_Transform(ST_Union(geom), Find_SRID('public', {table_name}, {geometry_name})) AS geom
+            FROM {states} WHERE name = %(state_name)s
+        )
+        SELECT {columns}ST_Transform(
+                   CASE WHEN ST_CoveredBy(t.{geometry}, s.geom) THEN t.{geometry}
+                        ELSE ST_Intersection(t.{geometry}, s.geom) END,
+                   3857) AS geometry
+        {candidates}
+    """).format(
+        table_name=sql.Literal(table),
+        geometry_name=sql.Literal(geometry_column),
+        states=sql.Identifier(states_table),
+        columns=sql.SQL('').join(c + sql.SQL(', ') for c in select_columns),
+        geometry=sql.Identifier(geometry_column),
+        candidates=candidates,
+    )
+    return geopandas.read_postgis(query.as_string(conn), conn, geom_col='geometry',
+                                  params={'state_name': state_name, 'table': table}, crs='EPSG:3857')
+
+def postgis_source(conn, table, columns=None, geometry_column='shape', states_table='tl_2012_us_state'):
+    # A dataset that map_utilities and build_map accept in place of a
+    # GeoDataFrame: only the features of the requested state are fetched,
+    # already clipped and in EPSG:3857. By default the columns are the ones
+    # build_map reads.
+    if columns is None:
+        columns = label_columns
+    def clip_to_state(state_row):
+        state_name = state_row.NAME.iloc[0]
+        return query_state_features(conn, table, state_name, columns, geometry_column, states_table)
+    return clip_to_state
+
+def fast_clip(dataset, mask):
+    # Same result as geopandas.clip(dataset, mask). Candidates come from the
+    # dataset's STRtree, features fully inside the prepared mask are kept
+    # as they are, and only the ones crossing its boundary are intersected.
+    if isinstance(mask, (geopandas.GeoDataFrame, geopandas.GeoSeries)):
+        mask = shapely.union_all(np.asarray(mask.geometry.values))
+    shapely.prepare(mask)
+
+    candidates = np.sort(dataset.sindex.query(mask, predicate='intersects'))
+    geometries = np.asarray(dataset.geometry.values)[candidates]
+
+    inside = shapely.contains_properly(mask, geometries)
+    clipped = geometries.copy()
+    clipped[~inside] = shapely.intersection(geometries[~inside], mask)
+
+    clipped_dataset = dataset.iloc[candidates].copy()
+    clipped_dataset[dataset.geometry.name] = geopandas.GeoSeries(clipped, index=clipped_dataset.index, crs=dataset.crs)
+    return clipped_dataset[~shapely.is_empty(clipped)]
+
+def lazy_dataset(path, layer=None, columns=None, width_px=None):
+    # A dataset that map_utilities and build_map accept in place of a
+    # GeoDataFrame. Nothing is read until the state is known, then only the
+    # features inside the state's bbox and the requested columns are read:
+    # row groups are skipped for dataset store files, and the bbox is pushed
+    # down to pyogrio for GDBs and shapefiles. With width_px, the width of
+    # the map in pixels, store files are read from the coarsest LOD level
+    # that looks the same at that size.
+    def clip_to_state(state_row):
+        if path.endswith('.parquet'):
+            mask = state_row.geometry.to_crs(epsg=3857)
+            bounds = tuple(mask.total_bounds)
+            source = pick_lod(path, bounds, width_px) if width_px else path
+            dataset = read_store(source, bbox=bounds, columns=columns)
+            return fast_clip(dataset, mask)
+
+        mask = state_row.geometry.to_crs(pyogrio.read_info(path, layer=layer)['crs'])
+        dataset = geopandas.read_file(path, layer=layer, bbox=tuple(mask.total_bounds),
+                                      columns=columns, engine='pyogrio')
+        return fast_clip(dataset, mask).to_crs(epsg=3857)
+    return clip_to_state
+
+# The columns build_map reads from the eco provinces.
+label_columns = ['PROVINCE_ID', 'MAP_UNIT_NAME']
+
+def add_legend_labels(clipped_dataset):
+    # Map-Making.py adds LEG_LABELS to the whole layer before calling
+    # build_map; datasets read straight from a GDB or the store lack it.
+    if 'LEG_LABELS' not in clipped_dataset.columns:
+        clipped_dataset['LEG_LABELS'] = clipped_dataset['PROVINCE_ID'].map(str).str.cat(clipped_dataset['MAP_UNIT_NAME'], sep=" ")
+    return clipped_dataset
+
 def map_utilities(state_row, dataset):
     #state_row.geometry = state_row.geometry.apply(lambda x: make_valid(x))
-    
+
+    if callable(dataset):
+        return add_legend_labels(dataset(state_row))
+
     clipping_box = state_row.geometry.to_crs(epsg=4269)
 
-    clipped_dataset = geopandas.clip(dataset, clipping_box)
+    clipped_dataset = fast_clip(dataset, clipping_box)
     clipped_dataset = clipped_dataset.to_crs(epsg=3857)
     #eco_prov_names = clipped_eco_provinces.MAP_UNIT_NAME.unique()
-    #clipped_eco_provinces['LEG_LABELS'] = clipped_eco_provinces['PROVINCE_ID'].map(str).str.cat(clipped_eco_provinces['MAP_UNIT_NAME'], sep=" ")
     #clipped_eco_provinces['CENTER'] = clipped_eco_provinces.geometry.representative_point()
-    return clipped_dataset
+    return add_legend_labels(clipped_dataset)
 
 
 
@@ -71,56 +215,75 @@ def map_color_utils(clipped_dataset):
 
 
 
-#polygon_lists
-
-#centroids = [polygon.centroid for polygon in plist for plist in [list(multipol.geoms) for multipol in eco_provinces.geometry]]
 def centroids(clipped_eco_provinces):
-    polygon_lists = [list(multipol.geoms) if multipol.geom_type == 'MultiPolygon' else [multipol] for multipol in clipped_eco_provinces.geometry]
-    centroids = []
-    for plist in polygon_lists:
-        num_polygons = len(plist)
-        if num_polygons > 3:
-            ctr = MultiPolygon(plist).representative_point()
-            #if ctr.buffer(50).contains()
-            centroids.append(ctr)
-        elif num_polygons == 1:
-            centroids.append(plist[0].representative_point())
-
-        else:
-            for polygon in plist:
-                centroids.append(polygon.representative_point())
-
-    centroids_gdf = geopandas.GeoDataFrame(data=centroids)
-    centroids_gdf = centroids_gdf.set_geometry(col=centroids_gdf[0])
-    centroids_gdf = centroids_gdf.set_crs(crs=clipped_eco_provinces.crs)
-    
-    centroids_gdf = centroids_gdf.sjoin(clipped_eco_provinces)
-
+    # One label point per province, or one per part for provinces of two or
+    # three polygons. Parts are exploded with their row index, so the
+    # attributes come straight from the province without a spatial join.
+    geometries = np.asarray(clipped_eco_provinces.geometry.values)
+    is_multi = shapely.get_type_id(geometries) == shapely.GeometryType.MULTIPOLYGON
+    num_parts = np.where(is_multi, shapely.get_num_geometries(geometries), 1)
+    split = (num_parts == 2) | (num_parts == 3)
+
+    parts, part_rows = shapely.get_parts(geometries[split], return_index=True)
+    whole_rows = np.flatnonzero(~split)
+    rows = np.concatenate([whole_rows, np.flatnonzero(split)[part_rows]])
+    points = np.concatenate([shapely.point_on_surface(geometries[whole_rows]), shapely.point_on_surface(parts)])
+
+    order = np.argsort(rows, kind='stable')
+    rows, points = rows[order], points[order]
+    keep = ~shapely.is_empty(points)
+
+    centroids_gdf = clipped_eco_provinces.iloc[rows[keep]].copy()
+    centroids_gdf[centroids_gdf.geometry.name] = geopandas.GeoSeries(points[keep], index=centroids_gdf.index,
+                                                                     crs=clipped_eco_provinces.crs)
     return centroids_gdf
 
 
 
-def build_map(us_states_gdb, eco_provinces, state_name=''):
-    mpl.use('agg')
-    set_dpi()
+def report_progress(progress, stage, percent):
+    # progress is an optional callback(stage, percent), e.g. a job queue
+    # relaying render progress to the /map SSE stream.
+    if progress is not None:
+        progress(stage, percent)
+
+
+def build_map(us_states_gdb, eco_provinces, state_name='', dataset_version=None, dpi=300, progress=None):
+    # Draws on a standalone Figure with its own Agg canvas instead of pyplot,
+    # so no global state (backend, rcParams, current figure) is touched.
     #state_name = input("Enter a U.S. State Name to explore: ")
     
     state_name = state_name.title()
 
     state_row = us_states_gdb[us_states_gdb.NAME == state_name]
+    report_progress(progress, 'select state', 5)
     
 
-    clipped_eco_provinces, eco_prov_names = map_utilities(state_row, eco_provinces)
+    # dataset_version comes from clip_cache.dataset_version(path); with it,
+    # repeat renders of a state skip the clip, reprojection and label points.
+    cached = clip_cache.get(dataset_version, state_name) if dataset_version else None
+    if cached is not None:
+        clipped_eco_provinces, centroids_gdf = cached
+    else:
+        clipped_eco_provinces = map_utilities(state_row, eco_provinces)
+        report_progress(progress, 'clip', 30)
+        centroids_gdf = centroids(clipped_eco_provinces)
+        if dataset_version:
+            clip_cache.put(dataset_version, state_name, clipped_eco_provinces, centroids_gdf)
+
+    report_progress(progress, 'centroids', 40)
 
     eco_colors = map_color_utils(clipped_eco_provinces)
-    centroids_gdf = centroids(clipped_eco_provinces)
-    
+    report_progress(progress, 'colors', 45)
 
-    fig, ax = plt.subplots(layout='tight', edgecolor=(0.3, 0.5, 0.4, 0.7), linewidth=2)
+    fig = Figure(layout='tight', edgecolor=(0.3, 0.5, 0.4, 0.7), linewidth=2, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
 
 
     clipped_eco_provinces.plot(ax = ax, color=clipped_eco_provinces['colors'], legend=True,legend_kwds={'loc':(0.0, 0.0),'shadow':True},alpha=0.6, edgecolor='black', linewidth=0.5, figsize=(5, 7),zorder=1)
-    cx.add_basemap(ax=ax, zoom=7)
+    report_progress(progress, 'plot', 55)
+    add_basemap(ax)
+    report_progress(progress, 'basemap', 70)
     ax.set_axis_off()
     ax.set_title(label="{}".format(state_name), fontstyle='oblique',color='white',path_effects=[pe.Stroke(linewidth=1.20, foreground='green'),pe.Normal()],fontsize=15,position=(0.4,1.3), va='baseline',pad=7, ha='left')
 
@@ -167,8 +330,9 @@ def build_map(us_states_gdb, eco_provinces, state_name=''):
         vertices=np.concatenate([circle.vertices, star.vertices[::-1, ...]]),
         codes=np.concatenate([circle.codes, star.codes]))"""
 
-    plt.legend(handles=patches,labels=legend_labels, handler_map={tuple: HandlerTuple(ndivide=None)},handletextpad=1, bbox_to_anchor=(1, 1, 0, 0),loc='upper left', handleheight=3, handlelength=4.5, labelspacing=1.1, fontsize='x-small', facecolor='#cef0d8', framealpha=0.20)
+    ax.legend(handles=patches,labels=legend_labels, handler_map={tuple: HandlerTuple(ndivide=None)},handletextpad=1, bbox_to_anchor=(1, 1, 0, 0),loc='upper left', handleheight=3, handlelength=4.5, labelspacing=1.1, fontsize='x-small', facecolor='#cef0d8', framealpha=0.20)
     ax.set_frame_on(True)
+    report_progress(progress, 'legend', 80)
 
 
     #fig.set_path_effects(path_effects=[pe.Normal(),pe.SimpleLineShadow(shadow_color='k'),])
@@ -176,7 +340,8 @@ def build_map(us_states_gdb, eco_provinces, state_name=''):
     fig.set_facecolor(((252 / 255), (244 / 255), (222/255), 0.3))
 
     annotations = [child for child in ax.get_children() if isinstance(child, mpltext.Annotation)]
-    adjust_text(annotations, avoid_self=False)
+    place_labels(ax, annotations)
+    report_progress(progress, 'label adjust', 90)
 
     ax.get_children()[2].set(fontsize=4, alpha=0.3)
 
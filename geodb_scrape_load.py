@@ -1,17 +1,44 @@
+import hashlib
 import os
 import requests
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+import sys
+import threading
 import zipfile
-import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from bs4 import BeautifulSoup
 from urllib.request import urlopen
-from webscrape import extract, get_soup
+from webscrape import (extract, get_soup, catalog_strainer, table_attribs, db_name, table_name,
+                       read_catalog, diff_catalog, upsert_changes, changed_links, record_changes, gdb_name,
+                       archive_href)
+from dataset_store import build_stores, store_directory
 
 url = 'https://data.fs.usda.gov/geodata/edw/datasets.php'
 
 gdb_directory_path = 'gdb_directory'
-if not os.path.exists(gdb_directory_path):
-    os.makedirs(gdb_directory_path)
+max_concurrent_downloads = 4
+manifest_path = 'download_manifest.db'
+# Only fetch datasets that were added or modified in the catalog since the
+# last sync. Set to False for a full sync, where the manifest still skips
+# archives that are unchanged on the server.
+download_changed_only = True
+# Convert freshly downloaded GDBs into the pre-projected GeoParquet store.
+build_dataset_store = True
+
+# Formats to try for each dataset, in order. Later formats are only
+# downloaded when every earlier one fails.
+format_preference = ['gdb', 'shapefile']
+shapefile_extensions = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# sqlite3 connections are shared across download threads, so all manifest
+# access is serialized through this lock.
+manifest_lock = threading.Lock()
 
 
 def extract_links(url):
@@ -19,7 +46,7 @@ def extract_links(url):
     information from the website and save it to a data frame. The
     function returns the data frame for further processing. '''
 
-    soup = get_soup(url)
+    soup = get_soup(url, parse_only=catalog_strainer)
     
     url_prefix = "https://data.fs.usda.gov/geodata/edw/"
 
@@ -37,33 +64,484 @@ def extract_links(url):
     return gdb_links, shapefile_links
 
 
+def preferred_links(gdb_links, shapefile_links, preference=format_preference):
+    """Pairs up the parallel link lists from extract_links into one list of
+    candidate URLs per dataset, ordered by the format preference.
+
+    Args:
+        gdb_links: The geodatabase archive URLs.
+        shapefile_links: The shapefile archive URLs.
+        preference: The formats to try, e.g. ['gdb', 'shapefile'] or ['gdb'].
+
+    Returns:
+        A list with one list of fallback URLs per dataset.
+    """
+    by_format = {'gdb': gdb_links, 'shapefile': shapefile_links}
+    return [list(candidates) for candidates in zip(*(by_format[f] for f in preference))]
+
+
+def is_gdb_member(name):
+    """Keeps only the files inside the .gdb directory of an archive."""
+    return '.gdb/' in name
+
+
+def is_shapefile_member(name):
+    """Keeps only the files that make up a shapefile layer."""
+    return name.lower().endswith(shapefile_extensions)
+
+
+def member_filter_for(url):
+    """Returns the zip member filter matching the format of an archive URL."""
+    return is_gdb_member if url.lower().endswith('.gdb.zip') else is_shapefile_member
+
+
+
+def process_peak_rss_mb():
+    """Returns the peak resident set size of this process in megabytes.
+
+    This is the high-water mark of the whole process since it started, not
+    of one archive: it never goes down, and concurrent downloads share it.
+    """
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def download_to_spool(response, spool_file, chunk_size=1024 * 1024, hasher=None):
+    """Writes a streamed response to an open file one chunk at a time.
+
+    Args:
+        response: A requests response opened with stream=True.
+        spool_file: A writable binary file object.
+        chunk_size: The number of bytes held in memory per chunk.
+        hasher: An optional hashlib object updated with every chunk.
+
+    Returns:
+        The number of bytes written.
+    """
+    total_bytes = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if chunk:
+            spool_file.write(chunk)
+            total_bytes += len(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+    spool_file.flush()
+    return total_bytes
+
+
+def extract_members(zip_file, extract_to, buffer_size=1024 * 1024, member_filter=None):
+    """Extracts the members of an open zip file one at a time.
+
+    Each member is copied to disk through a fixed size buffer, so memory use
+    does not grow with the size of the archive or of any single member.
+
+    Args:
+        zip_file: An open zipfile.ZipFile.
+        extract_to: The directory to extract the contents to.
+        buffer_size: The number of bytes copied per read.
+        member_filter: An optional function of the member name, only
+            members for which it returns True are written.
+
+    Returns:
+        The number of members extracted.
+    """
+    count = 0
+    root = os.path.realpath(extract_to)
+    for member in zip_file.infolist():
+        if member_filter is not None and not member_filter(member.filename):
+            continue
+        target = os.path.realpath(os.path.join(root, member.filename))
+        if os.path.commonpath([root, target]) != root:
+            print(f"Skipping unsafe zip member: {member.filename}")
+            continue
+        if member.is_dir():
+            os.makedirs(target, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with zip_file.open(member) as source, open(target, 'wb') as destination:
+            shutil.copyfileobj(source, destination, buffer_size)
+        count += 1
+    return count
+
+
+def open_manifest(path=manifest_path):
+    """Opens the download manifest, creating its table if needed.
+
+    The manifest records the validators and content hash of every archive
+    that was downloaded and extracted, keyed on its URL.
+    """
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS downloads (
+               url TEXT PRIMARY KEY,
+               etag TEXT,
+               last_modified TEXT,
+               size INTEGER,
+               sha256 TEXT,
+               extract_to TEXT,
+               downloaded_at TEXT,
+               outputs TEXT
+           )"""
+    )
+    # Manifests from before the outputs column was added.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(downloads)")]
+    if 'outputs' not in columns:
+        conn.execute("ALTER TABLE downloads ADD COLUMN outputs TEXT")
+    conn.commit()
+    return conn
+
+
+def manifest_entry(manifest, url):
+    """Returns the manifest row for a URL as a dict, or None if the URL has
+    not been downloaded before."""
+    with manifest_lock:
+        cursor = manifest.execute(
+            "SELECT url, etag, last_modified, size, sha256, extract_to, outputs FROM downloads WHERE url = ?",
+            (url,),
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    entry = dict(zip(['url', 'etag', 'last_modified', 'size', 'sha256', 'extract_to', 'outputs'], row))
+    entry['outputs'] = entry['outputs'].split('\n') if entry['outputs'] else []
+    return entry
+
+
+def record_download(manifest, url, etag, last_modified, size, sha256, extract_to, outputs):
+    """Inserts or updates the manifest row for a URL. outputs are the top
+    level names the archive extracted into extract_to."""
+    with manifest_lock:
+        manifest.execute(
+            """INSERT OR REPLACE INTO downloads
+               (url, etag, last_modified, size, sha256, extract_to, downloaded_at, outputs)
+               VALUES (?, ?, ?, ?, ?, ?, datetime('now'), ?)""",
+            (url, etag, last_modified, size, sha256, extract_to, '\n'.join(outputs)),
+        )
+        manifest.commit()
+
+
+def archive_outputs(zip_file, member_filter=None):
+    """Returns the top level names an archive extracts, e.g. the .gdb
+    directory or the shapefile layer files."""
+    return sorted({name.split('/')[0] for name in zip_file.namelist()
+                   if member_filter is None or member_filter(name)})
+
+
+def extract_into_place(zip_file, extract_to, buffer_size=1024 * 1024, member_filter=None):
+    """Extracts an archive next to its destination, then moves it in.
+
+    The members go to a hidden temporary directory inside extract_to and
+    each top level output (e.g. the .gdb directory) replaces its old copy
+    only once the whole archive extracted, so a failure, including one that
+    ends in a format fallback, never leaves a half written dataset for the
+    loader to pick up.
+
+    Returns:
+        The number of members extracted and the top level names written.
+    """
+    os.makedirs(extract_to, exist_ok=True)
+    partial_dir = tempfile.mkdtemp(prefix='.partial-', dir=extract_to)
+    try:
+        members = extract_members(zip_file, partial_dir, buffer_size, member_filter)
+        outputs = archive_outputs(zip_file, member_filter)
+        for name in outputs:
+            source = os.path.join(partial_dir, name)
+            if not os.path.exists(source):
+                continue
+            target = os.path.join(extract_to, name)
+            if os.path.isdir(target):
+                # Moved aside first, a directory cannot be replaced in one rename.
+                old = tempfile.mkdtemp(prefix='.old-', dir=extract_to)
+                os.rename(target, os.path.join(old, name))
+                os.rename(source, target)
+                shutil.rmtree(old, ignore_errors=True)
+            else:
+                os.replace(source, target)
+        return members, outputs
+    finally:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+
+
+def conditional_headers(entry, extract_to):
+    """Builds If-None-Match / If-Modified-Since headers from a manifest entry.
+
+    No validators are sent when the archive was extracted somewhere else or
+    any of its own extracted files are gone, so the archive is fetched again.
+    """
+    if entry is None or entry['extract_to'] != extract_to or not entry['outputs']:
+        return {}
+    if not all(os.path.exists(os.path.join(extract_to, name)) for name in entry['outputs']):
+        return {}
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
 
-def download_and_extract_zip(url, extract_to=gdb_directory_path):
+def download_and_extract_zip(url, extract_to=gdb_directory_path, chunk_size=1024 * 1024, spool_dir=None, session=None, manifest=None,
+                             member_filter=None):
     """Downloads a zip file from a URL and extracts it to a specified directory.
 
+    The archive is streamed to a temporary spool file on disk and extracted
+    member by member, so at most a few chunks are held in memory regardless
+    of the archive size.
+
     Args:
         url: The URL of the zip file.
-        extract_to: The directory to extract the contents to (default is current directory).
+        extract_to: The directory to extract the contents to (default is gdb_directory).
+        chunk_size: The number of bytes read from the network per chunk.
+        spool_dir: The directory for the temporary spool file (default is the system temp directory).
+        session: An optional requests.Session to reuse pooled connections.
+        manifest: An optional manifest connection from open_manifest. When
+            given, the request is conditional and unchanged archives are
+            skipped without being extracted.
+        member_filter: An optional function of the member name used to
+            extract only the needed files, see member_filter_for.
+
+    Returns:
+        A dict with the url, bytes downloaded, download rate in bytes/sec,
+        members extracted, the peak RSS of the whole process so far in MB
+        (see process_peak_rss_mb) and whether the archive was skipped
+        as unchanged, or None if the download failed.
     """
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+        start = time.perf_counter()
+        http = session if session is not None else requests
+        entry = manifest_entry(manifest, url) if manifest is not None else None
+        headers = conditional_headers(entry, extract_to)
 
-        with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
-            zip_file.extractall(extract_to)
-        print(f"Successfully extracted to {extract_to}")
+        with http.get(url, stream=True, headers=headers) as response:
+            if response.status_code == 304:
+                print(f"Unchanged, skipping {url}")
+                return {'url': url, 'bytes': 0, 'bytes_per_sec': 0.0, 'members': 0,
+                        'process_peak_rss_mb': process_peak_rss_mb(), 'skipped': True}
+            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+
+            with tempfile.TemporaryFile(suffix='.zip', dir=spool_dir) as spool_file:
+                hasher = hashlib.sha256()
+                total_bytes = download_to_spool(response, spool_file, chunk_size, hasher)
+                elapsed = time.perf_counter() - start
+                digest = hasher.hexdigest()
+
+                # Some servers ignore the validators, so fall back to the
+                # content hash before re-extracting.
+                if headers and entry['sha256'] == digest:
+                    print(f"Unchanged content, skipping extraction of {url}")
+                    members = 0
+                    outputs = entry['outputs']
+                    skipped = True
+                else:
+                    spool_file.seek(0)
+                    with zipfile.ZipFile(spool_file) as zip_file:
+                        members, outputs = extract_into_place(zip_file, extract_to, chunk_size, member_filter)
+                    skipped = False
+
+            if manifest is not None:
+                record_download(manifest, url, response.headers.get('ETag'),
+                                response.headers.get('Last-Modified'), total_bytes,
+                                digest, extract_to, outputs)
+
+        stats = {
+            'url': url,
+            'bytes': total_bytes,
+            'bytes_per_sec': total_bytes / elapsed if elapsed > 0 else float('inf'),
+            'members': members,
+            'process_peak_rss_mb': process_peak_rss_mb(),
+            'skipped': skipped,
+        }
+        if not skipped:
+            print(f"Successfully extracted {members} files to {extract_to} "
+                  f"({total_bytes / 1e6:.1f} MB at {stats['bytes_per_sec'] / 1e6:.2f} MB/s, "
+                  f"process peak RSS {stats['process_peak_rss_mb']:.0f} MB)")
+        return stats
     except requests.exceptions.RequestException as e:
         print(f"Request error: {e}")
     except zipfile.BadZipFile as e:
          print(f"Zip file error: {e}. The URL might not point to a valid zip file.")
     except Exception as e:
         print(f"An error occurred: {e}")
+    return None
+
+def make_session(max_connections=max_concurrent_downloads):
+    """Creates a requests session whose per-host connection pool is sized
+    for the given number of concurrent downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def probe_size(url, session):
+    """Returns the Content-Length of a URL from a HEAD request, or 0 if the
+    server does not report it."""
+    try:
+        response = session.head(url, allow_redirects=True)
+        response.raise_for_status()
+        return int(response.headers.get('Content-Length', 0))
+    except (requests.exceptions.RequestException, ValueError):
+        return 0
+
+
+def download_with_fallback(candidates, extract_to=gdb_directory_path, **kwargs):
+    """Downloads the first archive in a list of candidate URLs that succeeds.
+
+    Only the layer files of each format are extracted. Later candidates are
+    only requested when the earlier ones fail.
+
+    Args:
+        candidates: The URLs to try, in order of preference.
+        extract_to: The directory to extract the contents to.
+        **kwargs: Passed on to download_and_extract_zip.
+
+    Returns:
+        The stats of the successful download, or None if all of them failed.
+    """
+    for i, link in enumerate(candidates):
+        stats = download_and_extract_zip(link, extract_to, member_filter=member_filter_for(link), **kwargs)
+        if stats is not None:
+            return stats
+        if i + 1 < len(candidates):
+            print(f"Falling back to {candidates[i + 1]}")
+    return None
+
+
+def download_all(urls, extract_to=gdb_directory_path, max_workers=max_concurrent_downloads,
+                 order='largest', priorities=None, session=None, manifest=None):
+    """Downloads and extracts a list of zip files with a bounded thread pool.
+
+    All workers share one session, so connections to the same host are
+    pooled and reused between archives.
+
+    Args:
+        urls: The URLs of the zip files. An item may also be a list of
+            fallback URLs for one dataset, see preferred_links.
+        extract_to: The directory to extract the contents to.
+        max_workers: The maximum number of concurrent downloads.
+        order: 'largest' to start the biggest archives first, 'priority' to
+            sort by the priorities mapping, or None to keep the given order.
+        priorities: A dict of url to priority, higher values start first.
+        session: An optional requests.Session, one is created if not given.
+        manifest: An optional manifest connection for incremental syncs.
+
+    Returns:
+        A dict of the first URL of each item to the stats returned by
+        download_and_extract_zip.
+    """
+    if not os.path.exists(extract_to):
+        os.makedirs(extract_to)
+    if session is None:
+        session = make_session(max_workers)
+
+    candidates = {}
+    for item in urls:
+        item = [item] if isinstance(item, str) else list(item)
+        candidates[item[0]] = item
+    urls = list(candidates)
+
+    sizes = {}
+    if order == 'largest':
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            sizes = dict(zip(urls, executor.map(lambda u: probe_size(u, session), urls)))
+        urls = sorted(urls, key=lambda u: sizes[u], reverse=True)
+    elif order == 'priority':
+        priorities = priorities or {}
+        urls = sorted(urls, key=lambda u: priorities.get(u, 0), reverse=True)
+
+    total_files = len(urls)
+    total_bytes = sum(sizes.values())
+    progress = {'files': 0, 'bytes': 0, 'failed': 0, 'skipped': 0}
+    start = time.perf_counter()
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_with_fallback, candidates[u], extract_to,
+                                   session=session, manifest=manifest): u for u in urls}
+        for future in as_completed(futures):
+            link = futures[future]
+            stats = future.result()
+            results[link] = stats
+
+            # Progress is only updated here, on the submitting thread.
+            progress['files'] += 1
+            if stats is None:
+                progress['failed'] += 1
+            else:
+                progress['bytes'] += stats['bytes']
+                progress['skipped'] += stats['skipped']
+            elapsed = time.perf_counter() - start
+            rate = progress['bytes'] / elapsed if elapsed > 0 else 0
+            of_bytes = f"/{total_bytes / 1e6:.1f}" if total_bytes else ""
+            print(f"[{progress['files']}/{total_files}] "
+                  f"{progress['bytes'] / 1e6:.1f}{of_bytes} MB, "
+                  f"{rate / 1e6:.2f} MB/s, {progress['skipped']} unchanged, "
+                  f"{progress['failed']} failed")
+
+    return results
+
+
+def successful_changes(changes, results, preference=format_preference):
+    """Drops the added and modified catalog entries whose download failed.
+
+    They stay out of the catalog and the change feed, so the next diff sees
+    them again and their download is retried.
+
+    Args:
+        changes: A change set from diff_catalog.
+        results: The results of download_all.
+        preference: The format preference the downloads were made with.
+
+    Returns:
+        A change set with only the entries that are on disk.
+    """
+    column = {'gdb': 'ESRI GDB', 'shapefile': 'Shapefile'}[preference[0]]
+    failed = {link for link, stats in results.items() if stats is None}
+    kept = dict(changes)
+    for change in ('added', 'modified'):
+        df = changes[change]
+        if len(df):
+            kept[change] = df[~archive_href(df[column]).isin(failed).to_numpy()]
+    return kept
+
+
+def main():
+    catalog_conn = sqlite3.connect(db_name)
+    changes = diff_catalog(read_catalog(catalog_conn, table_name), extract(url, table_attribs))
+    print(f"Catalog changes: {len(changes['added'])} added, {len(changes['removed'])} removed, "
+          f"{len(changes['modified'])} modified")
+
+    if download_changed_only:
+        gdb_links, shapefile_links = changed_links(changes)
+    else:
+        gdb_links, shapefile_links = extract_links(url)
+
+    manifest = open_manifest(manifest_path)
+    try:
+        results = download_all(preferred_links(gdb_links, shapefile_links), gdb_directory_path,
+                               max_workers=max_concurrent_downloads, manifest=manifest)
+    finally:
+        manifest.close()
+
+    if build_dataset_store:
+        fresh = {gdb_name(stats['url']) for stats in results.values()
+                 if stats is not None and not stats['skipped'] and stats['url'].endswith('.gdb.zip')}
+        if fresh:
+            build_stores(gdb_directory_path, store_directory, only=fresh)
 
-extract_links(url)
-gdb_links, shapefile_links = extract_links(url)
+    failed = sum(stats is None for stats in results.values())
+    if failed:
+        print(f"{failed} downloads failed, they will be retried on the next run")
+    changes = successful_changes(changes, results)
 
-for link in gdb_links:
-    download_and_extract_zip(link)
+    # The change feed tells the loader which GDBs to (re)load.
+    record_changes(changes, catalog_conn)
+    upsert_changes(changes, catalog_conn, table_name)
+    catalog_conn.close()
 
-for link in shapefile_links:
-    download_and_extract_zip(link)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import time
+from collections import defaultdict
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Candidate offsets around each point, in units of the label's width and
+# height, tried in order: in place first, then the 8 neighbours, then
+# further out.
+default_offsets = [(0, 0)] + [
+    (dx * r, dy * r)
+    for r in (1, 2)
+    for dx, dy in ((0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (-1, 1), (1, -1), (-1, -1))
+]
+
+
+def place_labels(ax, annotations, time_budget=0.5, offsets=default_offsets, padding=1.0):
+    ''' This function moves annotations so they do not overlap, as a
+    bounded-time replacement for adjust_text.
+
+    Label extents are measured once, with one draw of the figure. Each label
+    is then placed greedily at the first candidate offset whose box stays
+    inside the axes and does not hit an already placed label, using a
+    uniform grid for the collision queries. Once time_budget seconds of
+    searching have passed the remaining labels stay where they are; the
+    draw and measurement before it are not counted against the budget.
+
+    Args:
+        ax: The matplotlib Axes holding the annotations.
+        annotations: The Annotation artists to place.
+        time_budget: The maximum time in seconds spent searching, after
+            the labels are measured.
+        offsets: The candidate (dx, dy) offsets in label sizes.
+        padding: Extra pixels kept between labels.
+
+    Returns:
+        A dict with the number of labels placed, moved, left overlapping,
+        the time spent drawing and measuring them and the time spent
+        searching.
+    '''
+    measure_start = time.perf_counter()
+    stats = {'placed': 0, 'moved': 0, 'overlapping': 0, 'measure_seconds': 0.0, 'seconds': 0.0}
+    if not annotations:
+        return stats
+
+    fig = ax.figure
+    # A bare Figure has no renderer to measure text with.
+    if not hasattr(fig.canvas, 'get_renderer'):
+        FigureCanvasAgg(fig)
+    # Runs the layout engine so the measured extents match the saved figure.
+    fig.draw_without_rendering()
+    renderer = fig.canvas.get_renderer()
+    axes_box = ax.get_window_extent(renderer)
+
+    boxes = np.array([a.get_window_extent(renderer).extents for a in annotations])
+    boxes[:, :2] -= padding
+    boxes[:, 2:] += padding
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    cell = max(widths.max(), heights.max(), 1.0)
+
+    grid = defaultdict(list)
+    placed = []
+
+    def cells(box):
+        x0, y0, x1, y1 = (np.floor(np.asarray(box) / cell)).astype(int)
+        return [(i, j) for i in range(x0, x1 + 1) for j in range(y0, y1 + 1)]
+
+    def collides(box):
+        for key in cells(box):
+            for other in grid.get(key, ()):
+                o = placed[other]
+                if box[0] < o[2] and box[2] > o[0] and box[1] < o[3] and box[3] > o[1]:
+                    return True
+        return False
+
+    def inside(box):
+        return (box[0] >= axes_box.x0 and box[2] <= axes_box.x1
+                and box[1] >= axes_box.y0 and box[3] <= axes_box.y1)
+
+    start = time.perf_counter()
+    stats['measure_seconds'] = start - measure_start
+    deadline = start + time_budget
+    points_per_pixel = 72.0 / fig.dpi
+
+    for k, annotation in enumerate(annotations):
+        box = boxes[k]
+        chosen = None
+        if time.perf_counter() < deadline:
+            for dx, dy in offsets:
+                dx, dy = dx * widths[k], dy * heights[k]
+                candidate = (box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy)
+                if inside(candidate) and not collides(candidate):
+                    chosen = (dx, dy, candidate)
+                    break
+
+        if chosen is None:
+            candidate = tuple(box)
+            stats['overlapping'] += collides(candidate)
+        else:
+            dx, dy, candidate = chosen
+            if dx or dy:
+                # Offsets are given in points so they survive a change of dpi
+                # when the figure is saved.
+                annotation.set_anncoords('offset points')
+                annotation.xyann = (dx * points_per_pixel, dy * points_per_pixel)
+                stats['moved'] += 1
+            stats['placed'] += 1
+
+        placed.append(candidate)
+        for key in cells(candidate):
+            grid[key].append(len(placed) - 1)
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
@@ -1,8 +1,44 @@
+import hashlib
 import os
+import re
+import sqlite3
 import subprocess
 import sys #Import sys for exit()
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def create_postgis_database(db_name, db_user, db_password, delete_if_exists=False):
+import numpy as np
+import psycopg
+import pyarrow as pa
+import pyogrio
+import shapely
+from psycopg import sql
+from pyogrio.errors import DataLayerError, DataSourceError
+from pyogrio.raw import open_arrow
+from pyproj import CRS
+
+from webscrape import db_name as catalog_db_name, pending_gdb_names, mark_loaded
+
+# Features per transaction when ogr2ogr loads through COPY.
+default_group_size = 65536
+# Features per Arrow batch read by the native loader.
+default_batch_size = 65536
+# Records the state of every (GDB, layer) load, so reruns can resume.
+ledger_table = "load_ledger"
+
+# Multi geometry types and the single part type promoted into them.
+multi_geometry_types = {
+    "MultiPoint": (shapely.GeometryType.POINT, shapely.multipoints),
+    "MultiLineString": (shapely.GeometryType.LINESTRING, shapely.multilinestrings),
+    "MultiPolygon": (shapely.GeometryType.POLYGON, shapely.multipolygons),
+}
+
+def connect(db_name, db_user, db_password, db_host="localhost", db_port=5432, autocommit=False):
+    """Opens a psycopg connection to a database."""
+    return psycopg.connect(host=db_host, port=db_port, dbname=db_name, user=db_user,
+                           password=db_password, autocommit=autocommit)
+
+def create_postgis_database(db_name, db_user, db_password, delete_if_exists=False, db_host="localhost", db_port=5432):
     """
     Creates a new PostGIS database and enables the PostGIS extension.
 
@@ -11,143 +47,538 @@ def create_postgis_database(db_name, db_user, db_password, delete_if_exists=Fals
         db_user (str): The PostgreSQL user to use for database creation.
         db_password (str): The password for the PostgreSQL user.
         delete_if_exists (bool): if true, delete the existing database.
+        db_host (str): The PostgreSQL host.
+        db_port (int): The PostgreSQL port.
     """
-    # --- Delete the Database if it exists---
-    if delete_if_exists:
-        if database_exists(db_name, db_user):
-            try:
-                subprocess.run(
-                    [
-                        "dropdb",
-                        "-U",
-                        db_user,
-                        db_name,
-                    ],
-                    check=True,
-                    input=f"{db_password}\n",
-                    text=True,
-                )
+    try:
+        # CREATE/DROP DATABASE cannot run inside a transaction, or while
+        # connected to the database itself.
+        with connect("postgres", db_user, db_password, db_host, db_port, autocommit=True) as admin:
+            exists = admin.execute("SELECT 1 FROM pg_database WHERE datname = %s", (db_name,)).fetchone() is not None
+
+            # --- Delete the Database if it exists---
+            if delete_if_exists and exists:
+                admin.execute(sql.SQL("DROP DATABASE {}").format(sql.Identifier(db_name)))
                 print(f"Database '{db_name}' dropped successfully.")
-            except subprocess.CalledProcessError as e:
-                print(f"Error dropping database '{db_name}': {e}")
-            except FileNotFoundError:
-                print("Error: 'dropdb' command not found. Make sure PostgreSQL is installed and in your PATH.")
-                sys.exit()
-    # ----------------------------------------
+                exists = False
+            # ----------------------------------------
 
-    try:
-        # Create the database
-        subprocess.run(
-            [
-                "createdb",
-                "-U",
-                db_user,
-                "-E",
-                "UTF-8",  # Specify UTF-8 encoding
-                db_name,
-            ],
-            check=True,
-            input=f"{db_password}\n",
-            text=True,
-        )
-        print(f"Database '{db_name}' created successfully.")
+            if not exists:
+                admin.execute(sql.SQL("CREATE DATABASE {} ENCODING 'UTF8'").format(sql.Identifier(db_name)))
+                print(f"Database '{db_name}' created successfully.")
 
         # Enable PostGIS extension
-        subprocess.run(
-            [
-                "psql",
-                "-U",
-                db_user,
-                "-d",
-                db_name,
-                "-c",
-                "CREATE EXTENSION postgis;",
-            ],
-            check=True,
-            input=f"{db_password}\n",
-            text=True,
-        )
+        with connect(db_name, db_user, db_password, db_host, db_port) as conn:
+            conn.execute("CREATE EXTENSION IF NOT EXISTS postgis")
         print(f"PostGIS extension enabled in database '{db_name}'.")
 
-    except subprocess.CalledProcessError as e:
+    except psycopg.Error as e:
         print(f"Error creating database or enabling PostGIS: {e}")
+
+def pg_connection_string(db_name, db_user, db_password, db_host="localhost", db_port=5432):
+    """Builds the OGR PostgreSQL connection string for a database."""
+    return f"PG:host={db_host} port={db_port} dbname={db_name} user={db_user} password={db_password}"
+
+def gdb_content_hash(gdb_path):
+    """Returns the SHA-256 of every file in a GDB directory, in name order."""
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(gdb_path):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            hasher.update(os.path.relpath(path, gdb_path).encode("utf-8"))
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+    return hasher.hexdigest()
+
+def ensure_ledger(conn):
+    """Creates the load ledger table if it does not exist."""
+    conn.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS {} (
+                                gdb_path text NOT NULL,
+                                layer text NOT NULL,
+                                content_hash text,
+                                row_count bigint,
+                                load_duration double precision,
+                                status text NOT NULL,
+                                error text,
+                                updated_at timestamptz NOT NULL DEFAULT now(),
+                                PRIMARY KEY (gdb_path, layer)
+                            )""").format(sql.Identifier(ledger_table)))
+    # Ledgers created before failures were recorded lack the error column.
+    conn.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS error text").format(sql.Identifier(ledger_table)))
+    conn.commit()
+
+def layer_is_current(conn, gdb_path, layer, content_hash):
+    """Check if a layer was already loaded from a GDB with the same content."""
+    cursor = conn.execute(
+        sql.SQL("SELECT content_hash, status FROM {} WHERE gdb_path = %s AND layer = %s").format(
+            sql.Identifier(ledger_table)),
+        (gdb_path, layer),
+    )
+    row = cursor.fetchone()
+    return row is not None and row[0] == content_hash and row[1] == "loaded"
+
+def record_layer(conn, gdb_path, layer, content_hash, status, row_count=None, load_duration=None, error=None):
+    """Upserts the ledger row of a layer and commits, together with anything
+    else pending in the transaction."""
+    conn.execute(
+        sql.SQL("""INSERT INTO {} (gdb_path, layer, content_hash, row_count, load_duration, status, error)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s)
+                   ON CONFLICT (gdb_path, layer) DO UPDATE SET
+                       content_hash = EXCLUDED.content_hash,
+                       row_count = EXCLUDED.row_count,
+                       load_duration = EXCLUDED.load_duration,
+                       status = EXCLUDED.status,
+                       error = EXCLUDED.error,
+                       updated_at = now()""").format(sql.Identifier(ledger_table)),
+        (gdb_path, layer, content_hash, row_count, load_duration, status, error),
+    )
+    conn.commit()
+
+def staging_name(table):
+    """Returns the staging table a layer is loaded into before the swap."""
+    return f"stg_{table}"[:63]
+
+def swap_in_staging(conn, staging, table):
+    """
+    Replaces a table with its staging table, without committing.
+
+    The indexes and sequences of the staging table are renamed along with
+    it, so the next load can create its staging table again.
+    """
+    conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+    conn.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(staging), sql.Identifier(table)))
+    # Only the table's own indexes and sequences: a name prefix would also
+    # match the staging objects of other layers, e.g. stg_actv_silvtsi_*
+    # for stg_actv.
+    cursor = conn.execute(
+        "SELECT c.relname, c.relkind FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE i.indrelid = format('public.%%I', %s::text)::regclass "
+        "UNION "
+        "SELECT c.relname, c.relkind FROM pg_depend d JOIN pg_class c ON c.oid = d.objid "
+        "WHERE d.classid = 'pg_class'::regclass AND d.refclassid = 'pg_class'::regclass "
+        "AND d.refobjid = format('public.%%I', %s::text)::regclass AND c.relkind = 'S'",
+        (table, table),
+    )
+    for name, kind in cursor.fetchall():
+        if not name.startswith(staging):
+            continue
+        statement = "ALTER INDEX {} RENAME TO {}" if kind == "i" else "ALTER SEQUENCE {} RENAME TO {}"
+        conn.execute(sql.SQL(statement).format(
+            sql.Identifier(name), sql.Identifier((table + name[len(staging):])[:63])))
+
+def load_layer_with_ledger(conn, gdb_path, layer, content_hash, load):
+    """
+    Loads one layer through a staging table and records it in the ledger.
+
+    The layer is skipped if the ledger shows it loaded from the same GDB
+    content. Otherwise load(staging) fills the staging table and returns its
+    row count, and the swap and the ledger update commit together, so a
+    crash leaves either the old table or the new one. Any error fails only
+    this layer: its ledger row is marked failed with the error text.
+
+    Args:
+        conn: An open psycopg connection.
+        gdb_path (str): The path to the GDB.
+        layer (str): The layer name.
+        content_hash (str): The hash from gdb_content_hash.
+        load: A function of the staging table name returning the row count.
+
+    Returns:
+        bool: True if the layer is loaded and current.
+    """
+    if layer_is_current(conn, gdb_path, layer, content_hash):
+        print(f"Skipping '{os.path.basename(gdb_path)}:{layer}', already loaded and unchanged.")
+        return True
+
+    table = launder(layer)
+    staging = staging_name(table)
+    record_layer(conn, gdb_path, layer, content_hash, "loading")
+    start = time.perf_counter()
+    try:
+        row_count = load(staging)
+        swap_in_staging(conn, staging, table)
+        record_layer(conn, gdb_path, layer, content_hash, "loaded", row_count, time.perf_counter() - start)
+        return True
+    except psycopg.Error as e:
+        conn.rollback()
+        print(f"Error loading '{os.path.basename(gdb_path)}:{layer}' into PostGIS: {e}")
+        error = e
+    except (DataSourceError, DataLayerError) as e:
+        conn.rollback()
+        print(f"Error reading '{os.path.basename(gdb_path)}:{layer}': {e}")
+        error = e
+    except Exception as e:
+        # Anything else, e.g. an unsupported geometry or field type, would
+        # otherwise abort the batch and leave the row stuck at "loading".
+        conn.rollback()
+        print(f"Unexpected error loading '{os.path.basename(gdb_path)}:{layer}': {e!r}")
+        error = e
+    record_layer(conn, gdb_path, layer, content_hash, "failed", None, time.perf_counter() - start,
+                 f"{type(error).__name__}: {error}")
+    return False
+
+def list_gdb_layers(gdb_path):
+    """
+    Lists the layer names in a GDB.
+
+    Args:
+        gdb_path (str): The path to the GDB.
+
+    Returns:
+        list: The layer names, as reported by ogrinfo.
+    """
+    output = subprocess.check_output(["ogrinfo", "-ro", "-q", gdb_path], text=True)
+    # Lines look like "1: Actv_SilvTSI (Multi Polygon)"
+    layers = []
+    for line in output.splitlines():
+        match = re.match(r"\s*\d+:\s+(\S+)", line)
+        if match:
+            layers.append(match.group(1))
+    return layers
+
+def run_ogr2ogr(gdb_path, pg_conn, layer=None, group_size=default_group_size, table=None):
+    """
+    Loads a GDB, or a single layer of it, into PostGIS with ogr2ogr.
+
+    Rows are sent with COPY instead of INSERTs and committed every
+    group_size features.
+
+    Args:
+        gdb_path (str): The path to the GDB.
+        pg_conn (str): The OGR connection string from pg_connection_string.
+        layer (str): if given, only this layer is loaded.
+        group_size (int): The number of features per transaction.
+        table (str): if given, the layer is written to this table, replacing it.
+
+    Returns:
+        bool: True if ogr2ogr succeeded.
+    """
+    name = f"{os.path.basename(gdb_path)}:{layer}" if layer else os.path.basename(gdb_path)
+    command = [
+        "ogr2ogr",
+        "--config",
+        "PG_USE_COPY",
+        "YES",
+        "-gt",
+        str(group_size),
+        "-f",
+        "PostgreSQL",
+        pg_conn,
+        gdb_path,
+    ]
+    if table:
+        command[1:1] = ["-overwrite", "-nln", table]
+    if layer:
+        command.append(layer)
+    try:
+        subprocess.run(command, check=True)
+        print(f"Successfully loaded '{name}' into PostGIS.")
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error loading '{name}' into PostGIS: {e}")
+        return False
     except FileNotFoundError:
-        print("Error: 'createdb' or 'psql' command not found. Make sure PostgreSQL is installed and in your PATH.")
+        print("Error: 'ogr2ogr' command not found. Make sure GDAL is installed and in your PATH.")
         sys.exit()
 
-def load_gdb_to_postgis(gdb_directory, db_name, db_user, db_password):
+def load_gdb_layers(db_args, gdb_path, layers, content_hash, group_size=default_group_size):
+    """
+    Loads layers of a GDB with ogr2ogr, one at a time, through the ledger.
+
+    Args:
+        db_args (tuple): (db_name, db_user, db_password, db_host, db_port).
+        gdb_path (str): The path to the GDB.
+        layers (list): The layer names to load.
+        content_hash (str): The hash from gdb_content_hash, computed once
+            per GDB however many jobs its layers are split into.
+        group_size (int): The number of features per transaction.
+
+    Returns:
+        bool: True if every layer is loaded.
+    """
+    pg_conn = pg_connection_string(*db_args)
+
+    ok = True
+    with connect(*db_args) as conn:
+        for layer in layers:
+            def load_staging(staging, layer=layer):
+                if not run_ogr2ogr(gdb_path, pg_conn, layer, group_size, table=staging):
+                    raise psycopg.DataError(f"ogr2ogr failed for layer '{layer}'")
+                count = sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(staging))
+                return conn.execute(count).fetchone()[0]
+
+            ok &= load_layer_with_ledger(conn, gdb_path, layer, content_hash, load_staging)
+    return ok
+
+def load_gdb_to_postgis(gdb_directory, db_name, db_user, db_password, only=None, max_workers=1,
+                        split_layers=False, group_size=default_group_size, db_host="localhost", db_port=5432):
     """
     Loads all GDB files from a directory into a PostGIS database.
 
+    With max_workers > 1 the ogr2ogr jobs run in parallel, one per GDB, or
+    one per layer when split_layers is set, so large GDBs spread across
+    cores as well. Layers already in the load ledger with unchanged content
+    are skipped, so an interrupted load resumes where it stopped.
+
     Args:
         gdb_directory (str): The path to the directory containing GDB files.
         db_name (str): The name of the PostGIS database.
         db_user (str): The PostgreSQL user.
         db_password (str): The password for the PostgreSQL user.
+        only (set): if given, only the GDB names in this set are loaded.
+        max_workers (int): The number of ogr2ogr processes to run at once.
+        split_layers (bool): if true, load each layer of a GDB as its own job.
+        group_size (int): The number of features per transaction.
+        db_host (str): The PostgreSQL host.
+        db_port (int): The PostgreSQL port.
+
+    Returns:
+        list: The names of the GDBs that were loaded successfully.
     """
     if not os.path.exists(gdb_directory):
         print(f"Error: GDB directory '{gdb_directory}' not found.")
         sys.exit()
 
-    for filename in os.listdir(gdb_directory):
-        if filename.endswith(".gdb"):
+    db_args = (db_name, db_user, db_password, db_host, db_port)
+    with connect(*db_args) as conn:
+        ensure_ledger(conn)
+
+    jobs = []
+    failed = set()
+    for filename in sorted(os.listdir(gdb_directory)):
+        if filename.endswith(".gdb") and (only is None or filename in only):
             gdb_path = os.path.join(gdb_directory, filename)
             print(f"Processing: {gdb_path}")
-
             try:
-                # Use ogr2ogr to load the GDB into PostGIS
-                subprocess.run(
-                    [
-                        "ogr2ogr",
-                        "-f",
-                        "PostgreSQL",
-                        f"PG:host=localhost dbname={db_name} user={db_user} password={db_password}",
-                        gdb_path,
-                    ],
-                    check=True,
-                )
-                print(f"Successfully loaded '{filename}' into PostGIS database '{db_name}'.")
+                layers = list_gdb_layers(gdb_path)
             except subprocess.CalledProcessError as e:
-                print(f"Error loading '{filename}' into PostGIS: {e}")
+                print(f"Error listing layers of '{filename}': {e}")
+                failed.add(filename)
+                continue
             except FileNotFoundError:
-                 print("Error: 'ogr2ogr' command not found. Make sure GDAL is installed and in your PATH.")
-                 sys.exit()
+                print("Error: 'ogrinfo' command not found. Make sure GDAL is installed and in your PATH.")
+                sys.exit()
+            content_hash = gdb_content_hash(gdb_path)
+            if split_layers:
+                jobs.extend((filename, gdb_path, [layer], content_hash) for layer in layers)
+            else:
+                jobs.append((filename, gdb_path, layers, content_hash))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda job: load_gdb_layers(db_args, job[1], job[2], job[3], group_size), jobs))
+
+    failed |= {job[0] for job, ok in zip(jobs, results) if not ok}
+    loaded = []
+    for filename, _, _, _ in jobs:
+        if filename not in failed and filename not in loaded:
+            print(f"Successfully loaded '{filename}' into PostGIS database '{db_name}'.")
+            loaded.append(filename)
+    return loaded
+
+def launder(name):
+    """Lowercases a name and replaces anything but letters, digits and
+    underscores, the way ogr2ogr names PostgreSQL tables and columns."""
+    return re.sub(r"[^a-z0-9_]", "_", name.lower())
+
+def pg_column_type(arrow_type):
+    """
+    Maps an Arrow type to a PostgreSQL column type.
+
+    Returns:
+        tuple: The type used in CREATE TABLE and the psycopg type name used
+        for binary COPY.
+    """
+    if pa.types.is_boolean(arrow_type):
+        return "boolean", "bool"
+    if pa.types.is_int8(arrow_type) or pa.types.is_int16(arrow_type) or pa.types.is_uint8(arrow_type):
+        return "smallint", "int2"
+    if pa.types.is_int32(arrow_type) or pa.types.is_uint16(arrow_type):
+        return "integer", "int4"
+    if pa.types.is_integer(arrow_type):
+        return "bigint", "int8"
+    if pa.types.is_float32(arrow_type):
+        return "real", "float4"
+    if pa.types.is_floating(arrow_type):
+        return "double precision", "float8"
+    if pa.types.is_date(arrow_type):
+        return "date", "date"
+    if pa.types.is_timestamp(arrow_type):
+        if arrow_type.tz is not None:
+            return "timestamptz", "timestamptz"
+        return "timestamp", "timestamp"
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return "bytea", "bytea"
+    return "text", "text"
+
+def postgis_geometry_type(ogr_geometry_type):
+    """Maps a pyogrio geometry type such as 'MultiPolygon' to a PostGIS
+    geometry type. Unknown and mixed types become 'Geometry'."""
+    if not ogr_geometry_type:
+        return "Geometry"
+    name = ogr_geometry_type.replace(" Z", "").replace(" M", "").replace(" ", "")
+    if name in ("Point", "LineString", "Polygon") or name in multi_geometry_types:
+        return name
+    return "Geometry"
+
+def layer_srid(crs):
+    """Returns the EPSG code of a layer CRS, or 0 if it has none."""
+    if not crs:
+        return 0
+    return CRS.from_user_input(crs).to_epsg() or 0
+
+def promote_to_multi(geometries, geometry_type):
+    """Wraps single part geometries in their Multi type, so a layer fits
+    a column declared as e.g. MultiPolygon."""
+    if geometry_type not in multi_geometry_types:
+        return geometries
+    single_type, constructor = multi_geometry_types[geometry_type]
+    single = shapely.get_type_id(geometries) == single_type
+    if single.any():
+        geometries = geometries.copy()
+        geometries[single] = constructor(geometries[single], indices=np.arange(single.sum()))
+    return geometries
+
+def create_layer_table(conn, table, columns, geometry_column, geometry_type, srid):
+    """
+    Creates the table for a layer, replacing any existing one.
+
+    Args:
+        conn: An open psycopg connection.
+        table (str): The table name.
+        columns (list): (name, PostgreSQL type) pairs of the attribute columns.
+        geometry_column (str): The geometry column name, or None.
+        geometry_type (str): The PostGIS geometry type.
+        srid (int): The SRID of the geometry column.
+    """
+    definitions = [sql.SQL("ogc_fid serial PRIMARY KEY")]
+    definitions += [sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(pg_type)) for name, pg_type in columns]
+    if geometry_column:
+        definitions.append(sql.SQL("{} geometry({}, {})").format(
+            sql.Identifier(geometry_column), sql.SQL(geometry_type), sql.Literal(srid)))
+    conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+    conn.execute(sql.SQL("CREATE TABLE {} ({})").format(sql.Identifier(table), sql.SQL(", ").join(definitions)))
+
+def copy_layer(conn, gdb_path, layer, table=None, batch_size=default_batch_size, create_index=True, commit=True):
+    """
+    Loads one GDB layer into PostGIS in process.
+
+    The layer is read in Arrow batches with pyogrio and streamed through a
+    single binary COPY FROM STDIN. Geometries are sent as EWKB with the
+    layer SRID, and single part geometries are promoted to the declared
+    Multi type. Geometries are loaded as 2D.
+
+    Args:
+        conn: An open psycopg connection.
+        gdb_path (str): The path to the GDB.
+        layer (str): The layer name.
+        table (str): The target table, defaults to the laundered layer name.
+        batch_size (int): The number of features per Arrow batch.
+        create_index (bool): if true, build the GiST index after loading.
+        commit (bool): if false, leave the transaction open for the caller.
+
+    Returns:
+        int: The number of rows loaded.
+    """
+    table = table or launder(layer)
+    info = pyogrio.read_info(gdb_path, layer=layer)
+    geometry_type = postgis_geometry_type(info.get("geometry_type"))
+    srid = layer_srid(info.get("crs"))
+    start = time.perf_counter()
+    rows = 0
 
-def database_exists(db_name, db_user):
+    with open_arrow(gdb_path, layer=layer, batch_size=batch_size, force_2d=True, use_pyarrow=True) as (meta, reader):
+        source_geometry = meta["geometry_name"] or "wkb_geometry"
+        has_geometry = source_geometry in reader.schema.names
+        fields = [f for f in reader.schema if f.name != source_geometry]
+        types = [pg_column_type(f.type) for f in fields]
+        names = [launder(f.name) for f in fields]
+        geometry_column = launder(meta["geometry_name"] or "geom") if has_geometry else None
+
+        create_layer_table(conn, table, list(zip(names, [t[0] for t in types])), geometry_column, geometry_type, srid)
+
+        copy_columns = names + ([geometry_column] if geometry_column else [])
+        statement = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+            sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, copy_columns)))
+
+        with conn.cursor() as cursor, cursor.copy(statement) as copy:
+            # PostGIS reads binary geometry input as EWKB, which is exactly
+            # what a bytea field carries, so geometries are dumped as bytea.
+            copy.set_types([t[1] for t in types] + (["bytea"] if geometry_column else []))
+            for batch in reader:
+                columns = [batch.column(f.name).to_pylist() for f in fields]
+                if geometry_column:
+                    geometries = shapely.from_wkb(batch.column(source_geometry).to_numpy(zero_copy_only=False))
+                    geometries = shapely.set_srid(promote_to_multi(geometries, geometry_type), srid)
+                    columns.append(shapely.to_wkb(geometries, include_srid=True).tolist())
+                for row in zip(*columns):
+                    copy.write_row(row)
+                rows += batch.num_rows
+
+    if geometry_column and create_index:
+        conn.execute(sql.SQL("CREATE INDEX ON {} USING GIST ({})").format(
+            sql.Identifier(table), sql.Identifier(geometry_column)))
+    if commit:
+        conn.commit()
+
+    elapsed = time.perf_counter() - start
+    rate = rows / elapsed if elapsed > 0 else float("inf")
+    print(f"Loaded {rows} rows from '{layer}' into '{table}' in {elapsed:.1f}s ({rate:,.0f} rows/sec).")
+    return rows
+
+def bulk_load_gdb_to_postgis(gdb_directory, db_name, db_user, db_password, only=None,
+                             batch_size=default_batch_size, db_host="localhost", db_port=5432):
+    """
+    Loads all GDB files from a directory into a PostGIS database in process,
+    without spawning ogr2ogr. Every layer is loaded over the same connection,
+    through a staging table and the load ledger like load_gdb_to_postgis.
+
+    Args:
+        gdb_directory (str): The path to the directory containing GDB files.
+        db_name (str): The name of the PostGIS database.
+        db_user (str): The PostgreSQL user.
+        db_password (str): The password for the PostgreSQL user.
+        only (set): if given, only the GDB names in this set are loaded.
+        batch_size (int): The number of features per Arrow batch.
+        db_host (str): The PostgreSQL host.
+        db_port (int): The PostgreSQL port.
+
+    Returns:
+        list: The names of the GDBs that were loaded successfully.
+    """
+    if not os.path.exists(gdb_directory):
+        print(f"Error: GDB directory '{gdb_directory}' not found.")
+        sys.exit()
+
+    loaded = []
+    with connect(db_name, db_user, db_password, db_host, db_port) as conn:
+        ensure_ledger(conn)
+        for filename in sorted(os.listdir(gdb_directory)):
+            if not filename.endswith(".gdb") or (only is not None and filename not in only):
+                continue
+            gdb_path = os.path.join(gdb_directory, filename)
+            print(f"Processing: {gdb_path}")
+            content_hash = gdb_content_hash(gdb_path)
+            ok = True
+            for layer, _ in pyogrio.list_layers(gdb_path):
+                def load_staging(staging, layer=layer):
+                    return copy_layer(conn, gdb_path, layer, table=staging, batch_size=batch_size, commit=False)
+
+                ok &= load_layer_with_ledger(conn, gdb_path, layer, content_hash, load_staging)
+            if ok:
+                print(f"Successfully loaded '{filename}' into PostGIS database '{db_name}'.")
+                loaded.append(filename)
+    return loaded
+
+def database_exists(db_name, db_user, db_password=None, db_host="localhost", db_port=5432):
     """Check if a database exists."""
     try:
-        subprocess.run(
-            [
-                "psql",
-                "-U",
-                db_user,
-                "-lqt",
-                "-d",
-                "template1",
-            ],
-            check=True,
-            text=True,
-            capture_output=True
-        )
-        output = subprocess.check_output(
-          [
-              "psql",
-              "-U",
-              db_user,
-              "-lqt",
-              "-d",
-              "template1",
-          ],
-          text=True,
-      )
-
-        databases = [line.split("|")[0].strip() for line in output.splitlines()]
-
-        return db_name in databases
-    except subprocess.CalledProcessError:
-        return False
-    except FileNotFoundError:
-        print("Error: 'psql' command not found. Make sure PostgreSQL is installed and in your PATH.")
+        with connect("postgres", db_user, db_password, db_host, db_port, autocommit=True) as conn:
+            cursor = conn.execute("SELECT 1 FROM pg_database WHERE datname = %s", (db_name,))
+            return cursor.fetchone() is not None
+    except psycopg.Error as e:
+        print(f"Error connecting to PostgreSQL: {e}")
         return False
 
 def main():
@@ -156,13 +587,33 @@ def main():
     db_name = "usfs_gdb_db" #Replace with your database name.
     db_user = "dave" #Replace with your user name.
     db_password = "your_password" #Replace with your password.
-    delete_existing = True # change this to false if you do not want to delete the existing database.
+    db_host = "localhost"
+    db_port = 5432 # e.g. 5433 for a throwaway instance: pg_ctl -D usfs -o "-p 5433" start
+    loader = "native" # "native" to load in process over one connection, "ogr2ogr" to shell out.
+    max_workers = os.cpu_count() or 1 # number of ogr2ogr jobs to run in parallel.
+    split_layers = True # load the layers of each GDB as separate parallel jobs.
+    delete_existing = False # change this to true to drop the database and its load ledger, and reload everything.
+    changed_only = False # change this to true to only load the GDBs in the catalog change feed.
 
     # --- Create PostGIS Database ---
-    create_postgis_database(db_name, db_user, db_password, delete_if_exists=delete_existing)
+    create_postgis_database(db_name, db_user, db_password, delete_if_exists=delete_existing,
+                            db_host=db_host, db_port=db_port)
 
     # --- Load GDBs into PostGIS ---
-    load_gdb_to_postgis(gdb_directory, db_name, db_user, db_password)
+    catalog_conn = sqlite3.connect(catalog_db_name) if changed_only else None
+    only = pending_gdb_names(catalog_conn) if changed_only else None
+
+    if loader == "native":
+        loaded = bulk_load_gdb_to_postgis(gdb_directory, db_name, db_user, db_password, only=only,
+                                          db_host=db_host, db_port=db_port)
+    else:
+        loaded = load_gdb_to_postgis(gdb_directory, db_name, db_user, db_password, only=only,
+                                     max_workers=max_workers, split_layers=split_layers,
+                                     db_host=db_host, db_port=db_port)
+
+    if changed_only:
+        mark_loaded(catalog_conn, loaded)
+        catalog_conn.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import clip_cache
+from disk_cache import evict_lru, mark_used, record_write
+import render_pool
+
+map_cache_dir = './static/maps'
+map_cache_max_bytes = 512 * 1024 * 1024 # on-disk size cap, least recently used maps go first
+memory_max_bytes = 64 * 1024 * 1024 # PNG bytes kept in memory
+url_prefix = '/maps/'
+
+_memory = OrderedDict()
+_memory_bytes = 0
+# Request threads read the cache while the render pool's result thread
+# writes to it; one lock covers both tiers.
+_lock = threading.RLock()
+
+
+def render_key(dataset_version, state_name, style=None, dpi=300):
+    ''' This function returns the content address of a rendered map: a hash
+    of everything the PNG depends on. '''
+    payload = json.dumps({
+        'dataset_version': list(dataset_version),
+        'state': state_name.title(),
+        'style': style or {},
+        'dpi': dpi,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def map_url(key):
+    ''' This function returns the immutable URL of a rendered map. '''
+    return f'{url_prefix}{key}.png'
+
+
+def png_path(key, cache_dir=map_cache_dir):
+    return os.path.join(cache_dir, key[:2], key + '.png')
+
+
+def remember(key, png):
+    ''' This function adds PNG bytes to the in-memory LRU tier. Function
+    returns nothing. '''
+    global _memory_bytes
+    with _lock:
+        if key in _memory:
+            _memory_bytes -= len(_memory.pop(key))
+        _memory[key] = png
+        _memory_bytes += len(png)
+        while _memory_bytes > memory_max_bytes and len(_memory) > 1:
+            _, evicted = _memory.popitem(last=False)
+            _memory_bytes -= len(evicted)
+
+
+def forget(key):
+    ''' This function drops an entry from the in-memory tier. Function
+    returns nothing. '''
+    global _memory_bytes
+    with _lock:
+        png = _memory.pop(key, None)
+        if png is not None:
+            _memory_bytes -= len(png)
+
+
+def get_png(key, cache_dir=map_cache_dir):
+    ''' This function returns the PNG bytes of a rendered map, or None if it
+    is not cached. '''
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key]
+        path = png_path(key, cache_dir)
+        if not os.path.exists(path):
+            return None
+        mark_used(path)
+        with open(path, 'rb') as f:
+            png = f.read()
+        remember(key, png)
+        return png
+
+
+def put_png(key, png, cache_dir=map_cache_dir, max_bytes=map_cache_max_bytes):
+    ''' This function stores the PNG bytes of a rendered map. Function
+    returns nothing. '''
+    path = png_path(key, cache_dir)
+    with _lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(png)
+        os.replace(path + '.tmp', path)
+        remember(key, png)
+        record_write(cache_dir, len(png), max_bytes, '.png', on_remove=forget_path)
+
+
+def forget_path(path):
+    forget(os.path.basename(path)[:-len('.png')])
+
+
+def evict(cache_dir=map_cache_dir, max_bytes=map_cache_max_bytes):
+    ''' This function deletes the least recently used maps until the cache
+    fits in max_bytes. Function returns nothing. '''
+    with _lock:
+        evict_lru(cache_dir, max_bytes, '.png', on_remove=forget_path)
+
+
+def png_response(key, if_none_match=None, cache_dir=map_cache_dir):
+    ''' This function returns the (status, headers, body) a server should
+    send for a map URL. The content never changes for a key, so the
+    response is cacheable forever and revalidations get a 304. '''
+    etag = f'"{key}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'Content-Type': 'image/png',
+    }
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return 304, headers, b''
+    png = get_png(key, cache_dir)
+    if png is None:
+        return 404, {'Content-Type': 'text/plain'}, b'Not found'
+    return 200, headers, png
+
+
+async def cached_map(pool, state_name, dataset_path, layer=None, columns=None, dpi=300):
+    ''' This function returns the immutable URL of a state's map, rendering
+    it in the render pool only if it is not cached yet. '''
+    style = {'layer': layer, 'columns': list(columns) if columns else None}
+    key = render_key(clip_cache.dataset_version(dataset_path), state_name, style, dpi)
+    if get_png(key) is None:
+        png = await render_pool.render(pool, state_name, dataset_path, layer, columns, dpi)
+        put_png(key, png)
+    return map_url(key)
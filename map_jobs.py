@@ -0,0 +1,169 @@
+import multiprocessing
+import threading
+import time
+import uuid
+
+import clip_cache
+import map_cache
+import render_pool
+
+max_pending_jobs = 8 # renders queued or running before new requests are turned away
+finished_job_ttl = 300 # seconds a finished job stays around for late SSE readers
+keepalive_interval = 15 # seconds between SSE keepalive comments while a stage runs
+
+
+def start_jobs(workers=None, max_pending=max_pending_jobs, states=render_pool.states_path):
+    ''' This function starts the map job subsystem: a render pool, a thread
+    relaying worker progress to jobs, and the job table. Function returns the
+    jobs state to pass to submit_job and stream_progress. '''
+    context = multiprocessing.get_context('spawn')
+    progress_queue = context.Queue()
+    jobs = {
+        'pool': render_pool.start_pool(workers, states, progress_queue),
+        'progress_queue': progress_queue,
+        'slots': threading.BoundedSemaphore(max_pending),
+        'condition': threading.Condition(),
+        'jobs': {}, # job id -> job
+        'in_flight': {}, # render key -> job id, for coalescing duplicates
+    }
+    threading.Thread(target=relay_progress, args=(jobs,), daemon=True).start()
+    return jobs
+
+
+def stop_jobs(jobs):
+    ''' This function waits for running renders and shuts the subsystem
+    down. Function returns nothing. '''
+    jobs['pool'].close()
+    jobs['pool'].join()
+    jobs['progress_queue'].put((None, None, None))
+
+
+def relay_progress(jobs):
+    ''' This function runs in a thread, moving (job_id, stage, percent)
+    events from the workers onto the jobs and waking SSE readers. '''
+    while True:
+        job_id, stage, percent = jobs['progress_queue'].get()
+        if job_id is None:
+            return
+        with jobs['condition']:
+            job = jobs['jobs'].get(job_id)
+            if job is not None and not job['done'] and percent > job['percent']:
+                job['stage'] = stage
+                job['percent'] = percent
+                jobs['condition'].notify_all()
+
+
+def new_job(key, state_name):
+    return {'id': uuid.uuid4().hex, 'key': key, 'state': state_name, 'stage': 'queued',
+            'percent': 0, 'done': False, 'url': None, 'error': None, 'finished_at': None}
+
+
+def prune_jobs(jobs):
+    # Called with the condition held.
+    cutoff = time.monotonic() - finished_job_ttl
+    for job_id in [job['id'] for job in jobs['jobs'].values()
+                   if job['done'] and job['finished_at'] < cutoff]:
+        del jobs['jobs'][job_id]
+
+
+def finish_job(jobs, job_id, png=None, error=None):
+    ''' This function completes a job with its PNG bytes or an error, frees
+    its queue slot and wakes SSE readers. Function returns nothing. '''
+    job = jobs['jobs'][job_id]
+    if png is not None:
+        map_cache.put_png(job['key'], png)
+    with jobs['condition']:
+        if error is not None:
+            job['error'] = str(error)
+        else:
+            job['url'] = map_cache.map_url(job['key'])
+            job['stage'] = 'done'
+            job['percent'] = 100
+        job['done'] = True
+        job['finished_at'] = time.monotonic()
+        jobs['in_flight'].pop(job['key'], None)
+        jobs['slots'].release()
+        jobs['condition'].notify_all()
+
+
+def submit_job(jobs, state_name, dataset_path, layer=None, columns=None, dpi=300):
+    ''' This function queues the render of a state's map and returns the job
+    id right away. A request for a map that is already being rendered joins
+    that job, and a cached map returns a finished job. Function returns None
+    when the queue is full, so the caller can tell the client to retry. '''
+    state_name = state_name.title()
+    style = {'layer': layer, 'columns': list(columns) if columns else None}
+    key = map_cache.render_key(clip_cache.dataset_version(dataset_path), state_name, style, dpi)
+    cached = map_cache.get_png(key) is not None
+
+    with jobs['condition']:
+        prune_jobs(jobs)
+        if key in jobs['in_flight']:
+            return jobs['in_flight'][key]
+        job = new_job(key, state_name)
+        if cached:
+            job.update(stage='done', percent=100, done=True, url=map_cache.map_url(key),
+                       finished_at=time.monotonic())
+            jobs['jobs'][job['id']] = job
+            return job['id']
+        if not jobs['slots'].acquire(blocking=False):
+            return None
+        jobs['jobs'][job['id']] = job
+        jobs['in_flight'][key] = job['id']
+
+    job_id = job['id']
+    render_pool.submit_render(jobs['pool'], state_name, dataset_path, layer, columns, dpi,
+                              callback=lambda png: finish_job(jobs, job_id, png=png),
+                              error_callback=lambda e: finish_job(jobs, job_id, error=e),
+                              job_id=job_id)
+    return job_id
+
+
+def job_status(jobs, job_id):
+    ''' This function returns a copy of a job, or None if it is unknown. '''
+    with jobs['condition']:
+        job = jobs['jobs'].get(job_id)
+        return dict(job) if job is not None else None
+
+
+def stream_progress(jobs, job_id):
+    ''' This generator yields the SSE messages for a job: "data: <percent>"
+    as stages complete, then "data: url <map url>" or "data: Error ...".
+    It only waits on a condition, the render itself runs in the pool. '''
+    last_percent = None
+    last_sent = time.monotonic()
+    while True:
+        with jobs['condition']:
+            job = jobs['jobs'].get(job_id)
+            if job is not None and not job['done'] and job['percent'] == last_percent:
+                jobs['condition'].wait(keepalive_interval)
+                job = jobs['jobs'].get(job_id)
+            job = dict(job) if job is not None else None
+
+        if job is None:
+            yield 'data: Error: unknown map job\n\n'
+            return
+        if job['error'] is not None:
+            yield f"data: Error: {job['error']}\n\n"
+            return
+        if job['percent'] != last_percent:
+            last_percent = job['percent']
+            last_sent = time.monotonic()
+            yield f'data: {last_percent}\n\n'
+        elif time.monotonic() - last_sent >= keepalive_interval:
+            # Other jobs wake the condition too; only idle streams need this.
+            last_sent = time.monotonic()
+            yield ': keepalive\n\n'
+        if job['done']:
+            yield f"data: url {job['url']}\n\n"
+            return
+
+
+def map_events(jobs, state_name, dataset_path, layer=None, columns=None, dpi=300):
+    ''' This generator is the body of the /map SSE response: it submits the
+    job and streams its progress, or tells the client the server is busy. '''
+    job_id = submit_job(jobs, state_name, dataset_path, layer, columns, dpi)
+    if job_id is None:
+        yield 'data: Error: too many maps are being drawn, please try again shortly\n\n'
+        return
+    yield from stream_progress(jobs, job_id)
@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+
+from psycopg import sql
+
+from web_mercator import web_mercator_extent
+
+tile_cache_dir = "./mvt_cache"
+min_zoom, max_zoom = 0, 14
+mvt_extent = 4096 # MVT coordinate units per tile side
+mvt_buffer = 64 # units of geometry kept around a tile, so strokes join across edges
+url_prefix = "/tiles"
+
+def table_version(conn, table, schema="public"):
+    """
+    Returns the version of a table's contents, or None if there is no such
+    table.
+
+    Every load swaps in a new table (see swap_in_staging), so its OID changes
+    exactly when its contents do. Tile URLs carry it, which makes them
+    immutable.
+    """
+    cursor = conn.execute(
+        "SELECT c.oid FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relname = %s AND n.nspname = %s AND c.relkind = 'r'",
+        (table, schema),
+    )
+    row = cursor.fetchone()
+    return str(row[0]) if row else None
+
+def geometry_column(conn, table, schema="public"):
+    """Returns the (geometry column, srid) of a table from geometry_columns."""
+    cursor = conn.execute(
+        "SELECT f_geometry_column, srid FROM geometry_columns "
+        "WHERE f_table_schema = %s AND f_table_name = %s LIMIT 1",
+        (schema, table),
+    )
+    return cursor.fetchone()
+
+def attribute_columns(conn, table, schema="public"):
+    """Returns the columns of a table that can go into a tile as attributes."""
+    cursor = conn.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = %s "
+        "AND udt_name NOT IN ('geometry', 'geography', 'bytea') ORDER BY ordinal_position",
+        (schema, table),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def valid_tile(z, x, y):
+    """Check if z/x/y is a tile this service serves."""
+    return min_zoom <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def simplify_tolerance(z):
+    """
+    Returns the simplification tolerance in metres at a zoom level.
+
+    Half a screen pixel of a 256 pixel tile: the removed detail is smaller
+    than what ST_AsMVTGeom's quantization to the tile grid keeps anyway.
+    """
+    return 2 * web_mercator_extent / 2 ** z / 512
+
+def tile_query(table, geometry, srid, columns):
+    """Builds the query returning one layer of a tile as MVT bytes."""
+    return sql.SQL("""
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS tile,
+                   ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s, margin => %(margin)s), {srid}) AS search
+        ),
+        features AS (
+            -- Each feature is cut to the buffered tile first, so the
+            -- transform and the simplification only see the part in view,
+            -- not a whole national polygon at every zoom.
+            SELECT {columns}ST_AsMVTGeom(
+                       ST_SimplifyPreserveTopology(
+                           ST_Transform(ST_ClipByBox2D(t.{geometry}, bounds.search), 3857), %(tolerance)s),
+                       bounds.tile, {extent}, {buffer}, true) AS geom
+            FROM {table} t, bounds
+            WHERE t.{geometry} && bounds.search
+        )
+        SELECT ST_AsMVT(features, %(layer)s, {extent}, 'geom') FROM features WHERE geom IS NOT NULL
+    """).format(
+        srid=sql.Literal(srid),
+        columns=sql.SQL("").join(sql.SQL("t.{}, ").format(sql.Identifier(c)) for c in columns),
+        geometry=sql.Identifier(geometry),
+        extent=sql.Literal(mvt_extent),
+        buffer=sql.Literal(mvt_buffer),
+        table=sql.Identifier(table),
+    )
+
+def render_tile(conn, table, z, x, y, columns=None):
+    """
+    Renders one tile of a table in PostGIS.
+
+    Args:
+        conn: An open psycopg connection.
+        table (str): The table, which must have a GiST index on its geometry.
+        z, x, y (int): The tile.
+        columns (list): Attributes to include, all of them if None.
+
+    Returns:
+        bytes: The MVT, empty if no feature touches the tile.
+    """
+    geometry, srid = geometry_column(conn, table)
+    if columns is None:
+        columns = attribute_columns(conn, table)
+    cursor = conn.execute(tile_query(table, geometry, srid, columns), {
+        "z": z, "x": x, "y": y,
+        "margin": mvt_buffer / mvt_extent,
+        "tolerance": simplify_tolerance(z),
+        "layer": table,
+    })
+    row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] else b""
+
+def tile_path(table, version, z, x, y, cache_dir=tile_cache_dir):
+    """Returns the cache path of a tile."""
+    return os.path.join(cache_dir, table, version, str(z), str(x), f"{y}.pbf")
+
+def drop_old_versions(table, version, cache_dir=tile_cache_dir):
+    """Deletes the cached tiles of every other version of a table."""
+    table_dir = os.path.join(cache_dir, table)
+    for name in os.listdir(table_dir):
+        if name != version:
+            shutil.rmtree(os.path.join(table_dir, name), ignore_errors=True)
+
+def get_tile(conn, table, version, z, x, y, columns=None, cache_dir=tile_cache_dir):
+    """
+    Returns a tile from the disk cache, rendering and caching it first if
+    needed. Empty tiles are cached too.
+
+    Returns:
+        bytes: The MVT, or None if version is not the table's current one.
+    """
+    if version != table_version(conn, table):
+        return None
+    path = tile_path(table, version, z, x, y, cache_dir)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    tile = render_tile(conn, table, z, x, y, columns)
+    first_of_version = not os.path.exists(os.path.join(cache_dir, table, version))
+    # Server threads may render the same tile at once, so each writes its
+    # own temporary file and the last replace wins.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(tile)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if first_of_version:
+        drop_old_versions(table, version, cache_dir)
+    return tile
+
+def tile_response(conn, table, version, z, x, y, if_none_match=None, columns=None, cache_dir=tile_cache_dir):
+    """
+    Returns the (status, headers, body) a server should send for
+    {url_prefix}/<table>/<version>/<z>/<x>/<y>.pbf. The URL changes whenever
+    the table is reloaded, so responses are cacheable forever.
+    """
+    if not valid_tile(z, x, y):
+        return 404, {"Content-Type": "text/plain"}, b"Not found"
+    etag = f'"{version}-{z}-{x}-{y}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Content-Type": "application/vnd.mapbox-vector-tile",
+        "Access-Control-Allow-Origin": "*",
+    }
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return 304, headers, b""
+    tile = get_tile(conn, table, version, z, x, y, columns, cache_dir)
+    if tile is None:
+        return 404, {"Content-Type": "text/plain"}, b"Not found"
+    if not tile:
+        return 204, headers, b""
+    return 200, headers, tile
+
+def tilejson(conn, table, base_url=""):
+    """
+    Returns the TileJSON document of a table, which a client-side vector
+    tile renderer (e.g. MapLibre GL) loads to find the current tile URLs.
+
+    Returns:
+        dict: The TileJSON, or None if there is no such table.
+    """
+    version = table_version(conn, table)
+    if version is None:
+        return None
+    geometry, srid = geometry_column(conn, table)
+    cursor = conn.execute(
+        sql.SQL("SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) "
+                "FROM (SELECT ST_Transform(ST_SetSRID(ST_Extent({geometry})::geometry, {srid}), 4326) AS e "
+                "FROM {table}) extent").format(geometry=sql.Identifier(geometry), srid=sql.Literal(srid),
+                                               table=sql.Identifier(table))
+    )
+    bounds = cursor.fetchone()
+    fields = {column: "" for column in attribute_columns(conn, table)}
+    return {
+        "tilejson": "3.0.0",
+        "name": table,
+        "tiles": [f"{base_url}{url_prefix}/{table}/{version}/{{z}}/{{x}}/{{y}}.pbf"],
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "bounds": [round(v, 6) for v in bounds] if bounds and bounds[0] is not None else [-180, -85.0511, 180, 85.0511],
+        "vector_layers": [{"id": table, "fields": fields, "minzoom": min_zoom, "maxzoom": max_zoom}],
+    }
@@ -0,0 +1,215 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg
+from psycopg import sql
+
+from load_geodb_to_postgis import connect, copy_layer, staging_name, swap_in_staging
+
+states_path = "tl_2012_us_state/tl_2012_us_state.shp"
+states_table = "tl_2012_us_state"
+membership_table = "state_membership"
+
+def table_exists(conn, table, schema="public"):
+    """Check if a table exists."""
+    cursor = conn.execute(
+        "SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relname = %s AND n.nspname = %s AND c.relkind = 'r'",
+        (table, schema),
+    )
+    return cursor.fetchone() is not None
+
+def spatial_tables(conn, schema="public"):
+    """
+    Lists the tables with a geometry column.
+
+    Returns:
+        list: (table, geometry column, srid) tuples from geometry_columns.
+    """
+    cursor = conn.execute(
+        "SELECT f_table_name, f_geometry_column, srid FROM geometry_columns "
+        "WHERE f_table_schema = %s ORDER BY f_table_name",
+        (schema,),
+    )
+    return cursor.fetchall()
+
+def spatial_index(conn, table, column, schema="public"):
+    """Returns the name of the GiST index on a table's geometry column, or
+    None if there is none."""
+    cursor = conn.execute(
+        """SELECT ic.relname
+           FROM pg_index i
+           JOIN pg_class tc ON tc.oid = i.indrelid
+           JOIN pg_namespace n ON n.oid = tc.relnamespace
+           JOIN pg_class ic ON ic.oid = i.indexrelid
+           JOIN pg_am am ON am.oid = ic.relam
+           JOIN pg_attribute a ON a.attrelid = tc.oid AND a.attnum = ANY(i.indkey)
+           WHERE tc.relname = %s AND n.nspname = %s AND a.attname = %s AND am.amname = 'gist'
+           LIMIT 1""",
+        (table, schema, column),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def primary_key(conn, table, schema="public"):
+    """Returns the single column primary key of a table, or None."""
+    cursor = conn.execute(
+        """SELECT a.attname
+           FROM pg_index i
+           JOIN pg_class tc ON tc.oid = i.indrelid
+           JOIN pg_namespace n ON n.oid = tc.relnamespace
+           JOIN pg_attribute a ON a.attrelid = tc.oid AND a.attnum = ANY(i.indkey)
+           WHERE tc.relname = %s AND n.nspname = %s AND i.indisprimary""",
+        (table, schema),
+    )
+    rows = cursor.fetchall()
+    return rows[0][0] if len(rows) == 1 else None
+
+def optimize_table(db_args, table, column):
+    """
+    Creates the GiST index of a table if it is missing, clusters the table
+    on it and refreshes its statistics.
+
+    Each call opens its own connection, so tables can be optimized in
+    parallel.
+
+    Args:
+        db_args (tuple): (db_name, db_user, db_password, db_host, db_port).
+        table (str): The table name.
+        column (str): The geometry column name.
+
+    Returns:
+        bool: True if the table was optimized.
+    """
+    start = time.perf_counter()
+    try:
+        with connect(*db_args, autocommit=True) as conn:
+            index = spatial_index(conn, table, column)
+            if index is None:
+                index = f"{table}_{column}_gist"[:63]
+                conn.execute(sql.SQL("CREATE INDEX {} ON {} USING GIST ({})").format(
+                    sql.Identifier(index), sql.Identifier(table), sql.Identifier(column)))
+                print(f"Created spatial index '{index}' on '{table}'.")
+            conn.execute(sql.SQL("CLUSTER {} USING {}").format(sql.Identifier(table), sql.Identifier(index)))
+            conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        print(f"Optimized '{table}' in {time.perf_counter() - start:.1f}s.")
+        return True
+    except psycopg.Error as e:
+        print(f"Error optimizing '{table}': {e}")
+        return False
+
+def load_states(conn, path=states_path):
+    """Loads the state boundaries into PostGIS unless they are already there."""
+    if table_exists(conn, states_table):
+        return
+    layer = os.path.splitext(os.path.basename(path))[0]
+    copy_layer(conn, path, layer, table=states_table)
+
+def build_state_membership(conn, tables):
+    """
+    Materializes which features of every loaded dataset intersect which
+    states, as (dataset, dataset_oid, feature_id, state_fips) rows.
+
+    The covering index on (state_fips, dataset, feature_id) lets a state
+    scoped query find its features with an index-only scan. dataset_oid is
+    the table's OID when its rows were computed; a reload swaps in a new
+    table, so query_state_features can tell stale rows apart.
+
+    The table is built under a staging name and swapped in at the end, so a
+    failing dataset leaves the previous table in place. Datasets without a
+    known SRID or whose query fails are skipped.
+
+    Args:
+        conn: An open psycopg connection in autocommit mode.
+        tables (list): (table, geometry column, srid) tuples.
+    """
+    staging = staging_name(membership_table)
+    conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+    conn.execute(sql.SQL("CREATE TABLE {} (dataset text NOT NULL, dataset_oid oid NOT NULL, "
+                         "feature_id bigint NOT NULL, state_fips text NOT NULL)").format(sql.Identifier(staging)))
+
+    for table, column, srid in tables:
+        if table in (states_table, membership_table, staging):
+            continue
+        if not srid:
+            print(f"Skipping '{table}': its geometry has no SRID.")
+            continue
+        key = primary_key(conn, table)
+        if key is None:
+            print(f"Skipping '{table}': it has no single column primary key.")
+            continue
+        # The states are reprojected once, so the join can use the dataset's
+        # own spatial index.
+        try:
+            conn.execute(
+                sql.SQL("""INSERT INTO {membership} (dataset, dataset_oid, feature_id, state_fips)
+                           WITH s AS MATERIALIZED (
+                               SELECT statefp, ST_Transform(geom, {srid}) AS geom FROM {states}
+                           )
+                           SELECT {dataset}, {table_oid}::regclass::oid, t.{key}, s.statefp
+                           FROM s JOIN {table} t ON ST_Intersects(t.{column}, s.geom)""").format(
+                    membership=sql.Identifier(staging),
+                    srid=sql.Literal(srid),
+                    states=sql.Identifier(states_table),
+                    dataset=sql.Literal(table),
+                    table_oid=sql.Literal(sql.Identifier("public", table).as_string(conn)),
+                    key=sql.Identifier(key),
+                    table=sql.Identifier(table),
+                    column=sql.Identifier(column),
+                )
+            )
+        except psycopg.Error as e:
+            print(f"Error computing the state membership of '{table}': {e}")
+            continue
+        print(f"Computed state membership of '{table}'.")
+
+    conn.execute(sql.SQL("CREATE INDEX ON {} (state_fips, dataset, feature_id) INCLUDE (dataset_oid)").format(
+        sql.Identifier(staging)))
+    with conn.transaction():
+        swap_in_staging(conn, staging, membership_table)
+    # VACUUM sets the visibility map, which index-only scans depend on.
+    conn.execute(sql.SQL("VACUUM ANALYZE {}").format(sql.Identifier(membership_table)))
+
+def optimize_database(db_name, db_user, db_password, db_host="localhost", db_port=5432,
+                      max_workers=None, states=states_path):
+    """
+    Runs the post-load optimize stage: spatial indexes, CLUSTER and ANALYZE
+    for every spatial table, then the state membership lookup table.
+
+    Args:
+        db_name (str): The name of the PostGIS database.
+        db_user (str): The PostgreSQL user.
+        db_password (str): The password for the PostgreSQL user.
+        db_host (str): The PostgreSQL host.
+        db_port (int): The PostgreSQL port.
+        max_workers (int): The number of tables to optimize at once.
+        states (str): The path to the state boundaries.
+    """
+    db_args = (db_name, db_user, db_password, db_host, db_port)
+
+    with connect(*db_args) as conn:
+        load_states(conn, states)
+
+    with connect(*db_args, autocommit=True) as conn:
+        tables = spatial_tables(conn)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        list(executor.map(lambda t: optimize_table(db_args, t[0], t[1]), tables))
+
+    with connect(*db_args, autocommit=True) as conn:
+        build_state_membership(conn, tables)
+
+def main():
+    # --- Configuration ---
+    db_name = "usfs_gdb_db" #Replace with your database name.
+    db_user = "dave" #Replace with your user name.
+    db_password = "your_password" #Replace with your password.
+    db_host = "localhost"
+    db_port = 5432
+    max_workers = os.cpu_count() or 1 # number of tables to index and cluster in parallel.
+
+    optimize_database(db_name, db_user, db_password, db_host, db_port, max_workers=max_workers)
+
+if __name__ == "__main__":
+    main()
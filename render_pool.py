@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+
+states_path = 'tl_2012_us_state/tl_2012_us_state.shp'
+
+# Per worker process state, set up once by init_worker.
+_states = None
+_datasets = {}
+_progress_queue = None
+
+
+def init_worker(states=states_path, progress_queue=None):
+    ''' This function runs once in every worker process. It imports the
+    plotting stack and loads the state boundaries, so renders start warm.
+    Render progress is put on progress_queue as (job_id, stage, percent). '''
+    global _states, _progress_queue
+    _progress_queue = progress_queue
+    import matplotlib
+    matplotlib.use('agg')
+    import geopandas
+    import contextily # noqa: F401
+    import functions # noqa: F401
+
+    _states = geopandas.read_file(states)
+
+
+def report(job_id, stage, percent):
+    if job_id is not None and _progress_queue is not None:
+        _progress_queue.put((job_id, stage, percent))
+
+
+def render_png(state_name, dataset_path, layer=None, columns=None, dpi=300, job_id=None):
+    ''' This function renders the map of a state in a worker process and
+    returns the PNG bytes. With a job_id, progress is reported per stage. '''
+    import clip_cache
+    import matplotlib
+    from functions import build_map, label_columns, lazy_dataset
+
+    # build_map labels and colours the features by these columns.
+    if columns:
+        columns = list(columns) + [c for c in label_columns if c not in columns]
+
+    # Store files are read from the coarsest LOD level that is lossless at
+    # the figure's width, so clipped features are cached per width too.
+    width_px = int(dpi * matplotlib.rcParams['figure.figsize'][0])
+    key = (dataset_path, layer, tuple(columns) if columns else None, width_px)
+    if key not in _datasets:
+        _datasets[key] = lazy_dataset(dataset_path, layer, columns, width_px=width_px)
+    # The layer and columns pick different features from the same file, so
+    # they are part of the clip cache key along with the width.
+    name, digest = clip_cache.dataset_version(dataset_path)
+    if layer:
+        name = f'{name}.{layer}'
+    if columns:
+        name = f"{name}+{hashlib.sha256(','.join(columns).encode('utf-8')).hexdigest()[:8]}"
+    if dataset_path.endswith('.parquet'):
+        name = f'{name}@{width_px}px'
+
+    fig = build_map(_states, _datasets[key], state_name,
+                    dataset_version=(name, digest), dpi=dpi,
+                    progress=lambda stage, percent: report(job_id, stage, percent))
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi)
+    report(job_id, 'encode', 100)
+    return buffer.getvalue()
+
+
+def start_pool(workers=None, states=states_path, progress_queue=None):
+    ''' This function starts the render pool: workers processes, all forked
+    up front and initialized by init_worker. Spawned rather than forked, so
+    it is safe to start from a threaded web server. progress_queue must come
+    from the spawn context, e.g. multiprocessing.get_context('spawn').Queue(). '''
+    context = multiprocessing.get_context('spawn')
+    return context.Pool(processes=workers or os.cpu_count() or 1, initializer=init_worker,
+                        initargs=(states, progress_queue))
+
+
+def submit_render(pool, state_name, dataset_path, layer=None, columns=None, dpi=300,
+                  callback=None, error_callback=None, job_id=None):
+    ''' This function queues a render job and returns its AsyncResult, whose
+    get() returns the PNG bytes. '''
+    return pool.apply_async(render_png, (state_name, dataset_path, layer, columns, dpi, job_id),
+                            callback=callback, error_callback=error_callback)
+
+
+async def render(pool, state_name, dataset_path, layer=None, columns=None, dpi=300):
+    ''' This function renders a map in the pool and returns the PNG bytes,
+    without blocking the event loop. '''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(method, value):
+        if not future.done():
+            method(value)
+
+    submit_render(pool, state_name, dataset_path, layer, columns, dpi,
+                  callback=lambda png: loop.call_soon_threadsafe(resolve, future.set_result, png),
+                  error_callback=lambda e: loop.call_soon_threadsafe(resolve, future.set_exception, e))
+    return await future
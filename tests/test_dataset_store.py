@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+geopandas = pytest.importorskip('geopandas')
+pytest.importorskip('pyogrio')
+pytest.importorskip('pyarrow')
+shapely = pytest.importorskip('shapely')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import dataset_store # noqa: E402
+
+
+def test_build_store_writes_parquet_from_gpkg(tmp_path):
+    gpkg = str(tmp_path / 'activities.gpkg')
+    polygons = [shapely.box(-105 + i, 40, -104.5 + i, 40.5) for i in range(5)]
+    gdf = geopandas.GeoDataFrame({'ACTIVITY_ID': range(5)}, geometry=polygons, crs='EPSG:4269')
+    gdf.to_file(gpkg, layer='Activity', engine='pyogrio')
+
+    path = dataset_store.build_store(gpkg, 'Activity', str(tmp_path / 'store'), lod_tolerances=None)
+
+    assert path == dataset_store.store_path(gpkg, 'Activity', str(tmp_path / 'store'))
+    assert os.path.exists(path)
+    stored = dataset_store.read_store(path)
+    assert stored.geometry.name == 'geometry'
+    assert sorted(stored['ACTIVITY_ID']) == list(range(5))
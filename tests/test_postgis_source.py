@@ -0,0 +1,59 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+geopandas = pytest.importorskip('geopandas')
+psycopg = pytest.importorskip('psycopg')
+shapely = pytest.importorskip('shapely')
+pytest.importorskip('matplotlib')
+pytest.importorskip('contextily')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import basemap # noqa: E402
+from functions import build_map, label_columns, postgis_source # noqa: E402
+
+# A PostGIS database the test may create and drop tables in.
+dsn = os.environ.get('USFS_TEST_POSTGIS_DSN')
+
+
+@pytest.fixture
+def conn():
+    if not dsn:
+        pytest.skip('USFS_TEST_POSTGIS_DSN is not set')
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        yield conn
+
+
+def test_build_map_from_postgis_source(conn, monkeypatch):
+    # Tables are created the way the loaders leave them: laundered,
+    # lower-case column names.
+    suffix = uuid.uuid4().hex[:8]
+    table, states_table = f'eco_provinces_{suffix}', f'states_{suffix}'
+    state = shapely.box(-109, 37, -102, 41)
+    provinces = [shapely.box(-110, 36, -105, 42), shapely.box(-105, 36, -101, 42)]
+    try:
+        conn.execute(f"CREATE TABLE {states_table} (name text, statefp text, geom geometry(Polygon, 4269))")
+        conn.execute(f"INSERT INTO {states_table} VALUES ('Colorado', '08', ST_GeomFromText(%s, 4269))",
+                     (state.wkt,))
+        conn.execute(f"CREATE TABLE {table} (objectid serial PRIMARY KEY, province_id text, "
+                     "map_unit_name text, shape geometry(Polygon, 4269))")
+        for i, province in enumerate(provinces):
+            conn.execute(f"INSERT INTO {table} (province_id, map_unit_name, shape) "
+                         "VALUES (%s, %s, ST_GeomFromText(%s, 4269))",
+                         (f'M33{i}', f'Province {i}', province.wkt))
+
+        states = geopandas.GeoDataFrame({'NAME': ['Colorado']}, geometry=[state], crs='EPSG:4269').to_crs(3857)
+        source = postgis_source(conn, table, states_table=states_table)
+        clipped = source(states)
+        assert set(label_columns) <= set(clipped.columns)
+
+        monkeypatch.setattr(basemap, 'offline_mode', True)
+        fig = build_map(states, source, 'Colorado', dpi=50)
+        legend = fig.axes[0].get_legend()
+        assert [t.get_text() for t in legend.get_texts()][-1] == 'Colorado'
+        assert len(legend.get_texts()) == len(provinces) + 1
+    finally:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(f"DROP TABLE IF EXISTS {states_table}")
@@ -0,0 +1,260 @@
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+from matplotlib import cm
+
+from dataset_store import read_store
+from web_mercator import web_mercator_extent
+
+min_zoom, max_zoom = 3, 10
+tile_size = 256
+tiles_per_task = 64 # tiles a worker renders per task, and per resumable commit
+fingerprints_file = 'fingerprints.db' # next to the tiles of a z/x/y directory
+
+# Drawn like the provinces in functions.build_map.
+default_style = {'alpha': 0.6, 'edgecolor': 'black', 'linewidth': 0.5}
+
+# Per worker process state, set up once by init_worker.
+_features = None
+_style = None
+_figure = None
+
+
+def tile_bounds(z, x, y):
+    """Returns the (xmin, ymin, xmax, ymax) of a tile in EPSG:3857."""
+    tile_m = 2 * web_mercator_extent / 2 ** z
+    xmin = -web_mercator_extent + x * tile_m
+    ymax = web_mercator_extent - y * tile_m
+    return xmin, ymax - tile_m, xmin + tile_m, ymax
+
+
+def tile_range(bounds, z):
+    """Returns the (xmin, ymin, xmax, ymax) tile indices covering a bbox."""
+    tile_m = 2 * web_mercator_extent / 2 ** z
+    last = 2 ** z - 1
+    xmin, ymin, xmax, ymax = bounds
+    return (min(max(math.floor((xmin + web_mercator_extent) / tile_m), 0), last),
+            min(max(math.floor((web_mercator_extent - ymax) / tile_m), 0), last),
+            min(max(math.floor((xmax + web_mercator_extent) / tile_m), 0), last),
+            min(max(math.floor((web_mercator_extent - ymin) / tile_m), 0), last))
+
+
+def feature_colors(features, color_column=None):
+    """Returns one RGBA colour per feature. Colours follow the sorted values
+    of color_column across the whole dataset, so a feature keeps its colour
+    in every tile."""
+    if color_column is None:
+        return np.tile(cm.tab20c(0), (len(features), 1))
+    codes, _ = pd.factorize(features[color_column], sort=True)
+    return cm.tab20c(np.mod(codes, 20))
+
+
+def tile_fingerprints(features, colors, style, zooms):
+    """Returns {(z, x, y): fingerprint} for every tile a feature's bbox
+    touches. A fingerprint hashes the geometry and colour of the tile's
+    features and the style, so it changes exactly when the tile would."""
+    style_key = json.dumps(style, sort_keys=True).encode('utf-8')
+    geometries = np.asarray(features.geometry.values)
+    # Missing and empty geometries draw nothing and have no WKB or bounds.
+    present = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+    geometries, colors = geometries[present], np.asarray(colors)[present]
+    digests = [hashlib.blake2b(wkb + color.tobytes(), digest_size=16).digest()
+               for wkb, color in zip(shapely.to_wkb(geometries), colors.astype(np.float32))]
+    bounds = shapely.bounds(geometries)
+
+    tile_features = {}
+    for digest, feature_bounds in zip(digests, bounds):
+        for z in zooms:
+            xmin, ymin, xmax, ymax = tile_range(feature_bounds, z)
+            for x in range(xmin, xmax + 1):
+                for y in range(ymin, ymax + 1):
+                    tile_features.setdefault((z, x, y), []).append(digest)
+
+    return {tile: hashlib.blake2b(style_key + b''.join(sorted(d)), digest_size=16).hexdigest()
+            for tile, d in tile_features.items()}
+
+
+def init_worker(path, color_column, style):
+    """Runs once in every worker process: loads the layer and sets up one
+    transparent figure that every tile is drawn on."""
+    global _features, _style, _figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    columns = [color_column] if color_column else []
+    features = read_store(path, columns=columns)
+    features['colors'] = list(feature_colors(features, color_column))
+    features.sindex # built once here rather than on the first tile
+    _features = features
+    _style = style
+
+    _figure = Figure(figsize=(1, 1), dpi=tile_size)
+    FigureCanvasAgg(_figure)
+    _figure.patch.set_alpha(0)
+
+
+def render_tile(z, x, y):
+    """Renders one overlay tile in a worker process. Returns the PNG bytes,
+    or None if no feature is inside the tile."""
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    # Geometry is cut a few pixels outside the tile, so the cut edges and
+    # their strokes stay out of sight.
+    margin = 4 * (xmax - xmin) / tile_size
+    rect = (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+
+    candidates = _features.sindex.query(shapely.box(*rect), predicate='intersects')
+    if len(candidates) == 0:
+        return None
+    tile_features = _features.iloc[np.sort(candidates)]
+    geometries = shapely.clip_by_rect(np.asarray(tile_features.geometry.values), *rect)
+    keep = ~shapely.is_empty(geometries)
+    if not keep.any():
+        return None
+    tile_features = tile_features[keep].copy()
+    tile_features[tile_features.geometry.name] = geopandas.GeoSeries(
+        geometries[keep], index=tile_features.index, crs=tile_features.crs)
+
+    _figure.clear()
+    ax = _figure.add_axes((0, 0, 1, 1))
+    ax.set_axis_off()
+    tile_features.plot(ax=ax, color=list(tile_features['colors']), **_style)
+    ax.set_xlim(xmin, xmax)
+    ax.set_ylim(ymin, ymax)
+    ax.set_aspect('auto')
+
+    buffer = io.BytesIO()
+    _figure.savefig(buffer, format='png', dpi=tile_size, transparent=True)
+    return buffer.getvalue()
+
+
+def render_tiles(tiles):
+    """Renders a batch of tiles in a worker process. Returns (tile, PNG
+    bytes or None) pairs."""
+    return [(tile, render_tile(*tile)) for tile in tiles]
+
+
+def is_mbtiles(output):
+    return output.endswith('.mbtiles')
+
+
+def open_output(output, name):
+    """Opens the fingerprint database of an output: the MBTiles file itself,
+    or fingerprints.db inside a z/x/y directory."""
+    if is_mbtiles(output):
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        db = sqlite3.connect(output)
+        db.execute("CREATE TABLE IF NOT EXISTS metadata (name text PRIMARY KEY, value text)")
+        db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, "
+                   "tile_row integer, tile_data blob, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", [
+            ('name', name), ('format', 'png'), ('type', 'overlay'),
+            ('minzoom', str(min_zoom)), ('maxzoom', str(max_zoom))])
+    else:
+        os.makedirs(output, exist_ok=True)
+        db = sqlite3.connect(os.path.join(output, fingerprints_file))
+    db.execute("CREATE TABLE IF NOT EXISTS tile_fingerprints (z integer, x integer, y integer, "
+               "fingerprint text, PRIMARY KEY (z, x, y))")
+    db.commit()
+    return db
+
+
+def write_tile(db, output, tile, png):
+    """Writes or, with png None, removes a tile. Returns nothing."""
+    z, x, y = tile
+    if is_mbtiles(output):
+        # MBTiles rows count from the bottom (TMS).
+        row = 2 ** z - 1 - y
+        if png is None:
+            db.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (z, x, row))
+        else:
+            db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, row, png))
+        return
+    path = os.path.join(output, str(z), str(x), f'{y}.png')
+    if png is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(png)
+    os.replace(path + '.tmp', path)
+
+
+def build_pyramid(path, output, color_column=None, zooms=None, style=None, workers=None):
+    """Pre-renders transparent overlay tiles of a dataset store layer.
+
+    Only tiles whose fingerprint differs from the one recorded for the
+    output are rendered, so a rerun after the source changes redoes only
+    the tiles it touches, and a rerun after an interruption picks up where
+    the last run stopped: fingerprints are committed with every batch.
+
+    Args:
+        path: The GeoParquet path from dataset_store.store_path.
+        output: A z/x/y directory, or a file ending in .mbtiles.
+        color_column: An optional column the fill colours follow.
+        zooms: The zoom levels, min_zoom to max_zoom by default.
+        style: Keyword arguments for GeoDataFrame.plot, default_style by default.
+        workers: The number of render processes, all CPUs by default.
+
+    Returns:
+        A dict with the number of tiles rendered, removed and unchanged.
+    """
+    zooms = list(range(min_zoom, max_zoom + 1)) if zooms is None else list(zooms)
+    style = default_style if style is None else style
+
+    columns = [color_column] if color_column else []
+    features = read_store(path, columns=columns)
+    fingerprints = tile_fingerprints(features, feature_colors(features, color_column), style, zooms)
+    del features
+
+    db = open_output(output, os.path.splitext(os.path.basename(path))[0])
+    recorded = {(z, x, y): fingerprint for z, x, y, fingerprint in
+                db.execute("SELECT z, x, y, fingerprint FROM tile_fingerprints")}
+    stale = sorted((tile for tile, fingerprint in fingerprints.items() if recorded.get(tile) != fingerprint),
+                   key=lambda t: (t[0], t[1] // 8, t[2] // 8, t[1], t[2]))
+    removed = [tile for tile in recorded if tile not in fingerprints and tile[0] in zooms]
+
+    for tile in removed:
+        write_tile(db, output, tile, None)
+        db.execute("DELETE FROM tile_fingerprints WHERE z = ? AND x = ? AND y = ?", tile)
+    db.commit()
+
+    print(f"{len(stale)} of {len(fingerprints)} tiles to render, {len(removed)} removed")
+    batches = [stale[i:i + tiles_per_task] for i in range(0, len(stale), tiles_per_task)]
+    done = 0
+    if batches:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                 initargs=(path, color_column, style)) as executor:
+            for results in executor.map(render_tiles, batches):
+                for tile, png in results:
+                    write_tile(db, output, tile, png)
+                db.executemany("INSERT OR REPLACE INTO tile_fingerprints VALUES (?, ?, ?, ?)",
+                               [(*tile, fingerprints[tile]) for tile, _ in results])
+                db.commit()
+                done += len(results)
+                print(f"Rendered {done}/{len(stale)} tiles", end='\r')
+        print()
+    db.close()
+    return {'rendered': len(stale), 'removed': len(removed), 'unchanged': len(fingerprints) - len(stale)}
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: tile_pyramid.py <store .parquet> <output directory or .mbtiles> [color column]")
+        sys.exit(1)
+    build_pyramid(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+
+if __name__ == "__main__":
+    main()
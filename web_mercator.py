@@ -0,0 +1,2 @@
+# Half the width of the Web Mercator (EPSG:3857) world in metres.
+web_mercator_extent = 20037508.342789244
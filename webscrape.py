@@ -4,17 +4,38 @@
 
 import pandas as pd 
 import numpy as np 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from datetime import datetime
+import hashlib
+import json
+import os
+import time
 import requests
 import sqlite3
 
+from disk_cache import evict_lru, mark_used, record_write
+
+try:
+    import lxml # noqa: F401
+    catalog_parser = 'lxml'
+except ImportError:
+    catalog_parser = 'html.parser'
+
 url = 'https://data.fs.usda.gov/geodata/edw/datasets.php'
 csv_path = './us_forest_service.csv'
 db_name = 'Forest_Service.db'
 table_name = 'Geometries'
+changes_table_name = 'Catalog_Changes'
+catalog_key = 'Feature Class'
 table_attribs = ['Feature Class', 'Description','ESRI GDB', 'Shapefile']
+url_prefix = 'https://data.fs.usda.gov/geodata/edw/'
+# Only the catalog table is built into the tree, the rest of the page is skipped.
+catalog_strainer = SoupStrainer('table', attrs={'class': 'fcTable'})
 log_file_path = './code_log.txt'
+cache_dir = './http_cache'
+cache_ttl = 24 * 60 * 60 # seconds before a cached page is revalidated
+cache_max_bytes = 64 * 1024 * 1024
+offline_mode = os.environ.get('USFS_OFFLINE', '') == '1' # serve cached pages only, never the network
 
 
 
@@ -27,26 +48,106 @@ def log_progress(message):
     with open(log_file_path, "a") as f:
         f.write(timestamp + ' : ' + message + '\n')
 
-def get_soup(url):
-    html_page = requests.get(url).text
-    html_soup = BeautifulSoup(html_page, 'html.parser')
+def cache_paths(url, cache_dir=cache_dir):
+    ''' This function returns the body and metadata file paths of the
+    cache entry for a URL. '''
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.html'), os.path.join(cache_dir, key + '.json')
+
+def read_cache(url, cache_dir=cache_dir):
+    ''' This function returns the metadata and text of the cached copy of
+    a URL, or (None, None) if there is no cached copy. '''
+    body_path, meta_path = cache_paths(url, cache_dir)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(body_path, encoding='utf-8') as f:
+            text = f.read()
+    except (OSError, ValueError):
+        return None, None
+    mark_used(body_path)
+    return meta, text
+
+def write_cache(url, text, headers, cache_dir=cache_dir):
+    ''' This function stores a page and its validators in the cache.
+    Function returns nothing. '''
+    os.makedirs(cache_dir, exist_ok=True)
+    body_path, meta_path = cache_paths(url, cache_dir)
+    meta = {
+        'url': url,
+        'fetched_at': time.time(),
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+    with open(body_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(body_path + '.tmp', body_path)
+    os.replace(meta_path + '.tmp', meta_path)
+
+def evict_cache(cache_dir=cache_dir, max_bytes=cache_max_bytes):
+    ''' This function deletes the least recently used cache entries until
+    the cache fits in max_bytes. Function returns nothing. '''
+    evict_lru(cache_dir, max_bytes, '.html', '.json')
+
+def fetch_cached(url, ttl=None, offline=None, cache_dir=cache_dir):
+    ''' This function returns the text of a page through the on-disk
+    cache. Fresh copies are served without a request, stale copies are
+    revalidated with If-None-Match / If-Modified-Since, and the last good
+    copy is served when offline or when the site cannot be reached. '''
+    ttl = cache_ttl if ttl is None else ttl
+    offline = offline_mode if offline is None else offline
+    meta, text = read_cache(url, cache_dir)
+
+    if text is not None and (offline or time.time() - meta['fetched_at'] < ttl):
+        return text
+    if offline:
+        raise FileNotFoundError(f"No cached copy of {url} is available in offline mode")
+
+    headers = {}
+    if text is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = requests.get(url, headers=headers, timeout=60)
+        if response.status_code == 304 and text is not None:
+            write_cache(url, text, {'ETag': meta.get('etag'), 'Last-Modified': meta.get('last_modified')}, cache_dir)
+            return text
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if text is None:
+            raise
+        print(f"Request error: {e}. Serving the cached copy of {url}")
+        return text
+
+    write_cache(url, response.text, response.headers, cache_dir)
+    record_write(cache_dir, len(response.content), cache_max_bytes, '.html', '.json')
+    return response.text
+
+def get_soup(url, ttl=None, offline=None, parse_only=None):
+    html_page = fetch_cached(url, ttl=ttl, offline=offline)
+    html_soup = BeautifulSoup(html_page, catalog_parser, parse_only=parse_only)
     return html_soup
 
 def make_clickable(val):
     # target _blank to open new window
     return '<a target="_blank" href="{}">{}</a>'.format(val, val)
 
-def extract(url, table_attribs):
-    ''' This function aims to extract the required
-    information from the website and save it to a data frame. The
-    function returns the data frame for further processing. '''
+def parse_catalog(html_page, table_attribs):
+    ''' This function parses the fcTable of a datasets.php page into a
+    data frame. Rows are collected into a list and the frame is built once,
+    so the cost is linear in the number of feature classes. '''
 
-    soup = get_soup(url)
-    df = pd.DataFrame(columns=table_attribs)
+    soup = BeautifulSoup(html_page, catalog_parser, parse_only=catalog_strainer)
 
     table = soup.find('table', {'class':'fcTable'})
     trs = table.find_all('tr')
     trs = trs[1:]
+    records = []
 
     for tr in trs:
 
@@ -56,31 +157,32 @@ def extract(url, table_attribs):
         gdb_link = links[0]['href']
         shapefile_link = links[1]['href']
 
-        "prepend https://data.fs.usda.gov/geodata/edw/"
-
         for td in tds:
 
             for p in td.find_all('p'):
 
                 for strong in p.find_all('strong'):
                     feature_class = strong.get_text(strip=True)
-                    data_dict = {
-                                    table_attribs[0]:feature_class,
-                                    table_attribs[1] : description,
-                                    table_attribs[2] : gdb_link,
-                                    table_attribs[3] : shapefile_link
-                    }
-                    df.loc[len(df)] = data_dict
+                    records.append((feature_class, description, gdb_link, shapefile_link))
+
+    df = pd.DataFrame.from_records(records, columns=table_attribs)
     df['Description'] = df['Description'].str.split('.')\
                                         .str.get(0)\
                                         .str.replace("…[see more]", ' ', regex=False)\
                                         + '.'
     #df.style.format({'ESRI GDB': make_clickable})
-    df['ESRI GDB'] = df['ESRI GDB'].apply(lambda x: '<a href="https://data.fs.usda.gov/geodata/edw/{}">ESRI Geodatabase</a>'.format(x))
-    df['Shapefile'] = df['Shapefile'].apply(lambda x: '<a href="https://data.fs.usda.gov/geodata/edw/{}">Shapefile</a>'.format(x))
+    df['ESRI GDB'] = '<a href="' + url_prefix + df['ESRI GDB'] + '">ESRI Geodatabase</a>'
+    df['Shapefile'] = '<a href="' + url_prefix + df['Shapefile'] + '">Shapefile</a>'
 
     return df
 
+def extract(url, table_attribs):
+    ''' This function aims to extract the required
+    information from the website and save it to a data frame. The
+    function returns the data frame for further processing. '''
+
+    return parse_catalog(fetch_cached(url), table_attribs)
+
 
 
 def transform(df, csv_path):
@@ -114,6 +216,120 @@ def load_to_db(df, sql_connection, table_name):
 
 
 
+def table_exists(sql_connection, table_name):
+    ''' This function returns True if the table exists in the database. '''
+
+    cursor = sql_connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+    return cursor.fetchone() is not None
+
+def read_catalog(sql_connection, table_name):
+    ''' This function reads the stored catalog from the database, or
+    returns an empty data frame if nothing has been stored yet. '''
+
+    if not table_exists(sql_connection, table_name):
+        return pd.DataFrame(columns=table_attribs)
+    return pd.read_sql(f'SELECT * FROM "{table_name}"', sql_connection)
+
+def diff_catalog(old_df, new_df, key=catalog_key):
+    ''' This function compares a new scrape with the stored catalog,
+    keyed on Feature Class. The function returns a dict of data frames
+    with the 'added', 'removed' and 'modified' entries. '''
+
+    old = old_df.drop_duplicates(key).set_index(key)
+    new = new_df.drop_duplicates(key).set_index(key)
+    columns = [c for c in new.columns if c in old.columns]
+
+    common = new.index.intersection(old.index)
+    old_common = old.loc[common, columns].fillna('').astype(str)
+    new_common = new.loc[common, columns].fillna('').astype(str)
+    modified = common[(old_common != new_common).any(axis=1).to_numpy()]
+
+    return {
+        'added': new.loc[new.index.difference(old.index)].reset_index(),
+        'removed': old.loc[old.index.difference(new.index)].reset_index(),
+        'modified': new.loc[modified].reset_index(),
+    }
+
+def upsert_changes(changes, sql_connection, table_name, key=catalog_key):
+    ''' This function applies a change set from diff_catalog to the
+    catalog table, deleting removed and modified rows and inserting added
+    and modified ones. Unchanged rows are not touched. Function returns
+    nothing. '''
+
+    stale_keys = pd.concat([changes['removed'][key], changes['modified'][key]])
+    if len(stale_keys) and table_exists(sql_connection, table_name):
+        sql_connection.executemany(
+            f'DELETE FROM "{table_name}" WHERE "{key}" = ?', [(k,) for k in stale_keys])
+
+    fresh = pd.concat([changes['added'], changes['modified']])
+    if len(fresh):
+        fresh.to_sql(table_name, sql_connection, if_exists='append', index=False)
+    sql_connection.commit()
+
+def archive_href(anchors):
+    ''' This function pulls the archive URL out of a column of the
+    formatted '<a href="...">' link cells. '''
+
+    return anchors.str.extract(r'href="([^"]+)"', expand=False)
+
+def changed_links(changes):
+    ''' This function returns the gdb and shapefile URLs of the added and
+    modified datasets, in the same shape as geodb_scrape_load.extract_links. '''
+
+    changed = pd.concat([changes['added'], changes['modified']])
+    return list(archive_href(changed['ESRI GDB'])), list(archive_href(changed['Shapefile']))
+
+def record_changes(changes, sql_connection, table_name=changes_table_name):
+    ''' This function appends a change set to the change feed table, where
+    the loader picks up the datasets it still has to load. Function returns
+    nothing. '''
+
+    frames = []
+    for change, df in changes.items():
+        if len(df):
+            frame = df[[catalog_key, 'ESRI GDB', 'Shapefile']].copy()
+            frame['Change'] = change
+            frame['Detected At'] = datetime.now().isoformat(timespec='seconds')
+            frame['Loaded'] = 0
+            frames.append(frame)
+    if frames:
+        pd.concat(frames).to_sql(table_name, sql_connection, if_exists='append', index=False)
+        sql_connection.commit()
+
+def gdb_name(href):
+    ''' This function returns the .gdb directory name an archive URL
+    extracts to, e.g. .../Actv_SilvTSI.gdb.zip -> Actv_SilvTSI.gdb '''
+
+    name = href.rstrip('/').split('/')[-1]
+    return name[:-len('.zip')] if name.endswith('.zip') else name
+
+def pending_gdb_names(sql_connection, table_name=changes_table_name):
+    ''' This function returns the .gdb names of added or modified datasets
+    that have not been loaded yet. '''
+
+    if not table_exists(sql_connection, table_name):
+        return set()
+    pending = pd.read_sql(
+        f'SELECT "ESRI GDB" FROM "{table_name}" WHERE "Loaded" = 0 AND "Change" != \'removed\'',
+        sql_connection)
+    return {gdb_name(href) for href in archive_href(pending['ESRI GDB']).dropna()}
+
+def mark_loaded(sql_connection, gdb_names, table_name=changes_table_name):
+    ''' This function marks the change feed entries of the given .gdb
+    names as loaded. Function returns nothing. '''
+
+    if not table_exists(sql_connection, table_name):
+        return
+    pending = pd.read_sql(f'SELECT rowid, "ESRI GDB" FROM "{table_name}" WHERE "Loaded" = 0', sql_connection)
+    names = archive_href(pending['ESRI GDB']).map(lambda href: gdb_name(href) if isinstance(href, str) else None)
+    rowids = pending.loc[names.isin(gdb_names), 'rowid']
+    sql_connection.executemany(
+        f'UPDATE "{table_name}" SET "Loaded" = 1 WHERE rowid = ?', [(int(r),) for r in rowids])
+    sql_connection.commit()
+
+
+
 
 
 def run_queries(query_statements, sql_connection):
@@ -129,22 +345,23 @@ def run_queries(query_statements, sql_connection):
 
 
 
-#log_progress("Preliminaries complete. Initiating ETL process")
+if __name__ == '__main__':
+    #log_progress("Preliminaries complete. Initiating ETL process")
 
-df = extract(url, table_attribs)
+    df = extract(url, table_attribs)
 
-#load_to_csv(df, csv_path)
-#log_progress("Data saved to CSV file")
+    #load_to_csv(df, csv_path)
+    #log_progress("Data saved to CSV file")
 
-conn = sqlite3.connect(db_name)
-#log_progress("SQL Connection initiated")
+    conn = sqlite3.connect(db_name)
+    #log_progress("SQL Connection initiated")
 
-#load_to_db(df, conn, table_name)
-#log_progress("Data loaded to Database as a table, Executing queries")
+    #load_to_db(df, conn, table_name)
+    #log_progress("Data loaded to Database as a table, Executing queries")
 
-query_statement = [f"SELECT * FROM Geometries LIMIT 5"]
-#run_queries(query_statement, conn)
-#log_progress("Process Complete")
+    query_statement = [f"SELECT * FROM Geometries LIMIT 5"]
+    #run_queries(query_statement, conn)
+    #log_progress("Process Complete")
 
 '''print("Extracted DF: \n", banks_df)
 log_progress("Data extraction complete. Initiating Transformation process")